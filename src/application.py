@@ -44,7 +44,9 @@ app = Flask(__name__)
 app.config.from_object(__name__)
 
 from model_resource import ServiceAccount
-from flask_identity_client.startup_funcs import user_required
+from flask_identity_client.startup_funcs import user_required, init_middles
+init_middles(app, 'MIDDLE_TEST')
+
 @app.route('/')
 def index():
     return user_required() or 'OK'
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# coding: UTF-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Request path benchmark: a real Flask application, like application.py,
+# talking to local stubs of PassaporteWeb and of a middle service.
+#
+#   python bench.py [-n 200] [--json] [scenario ...]
+
+import argparse
+import json
+import sys
+from BaseHTTPServer import BaseHTTPRequestHandler
+from SocketServer import ThreadingTCPServer
+from email.utils import formatdate
+from threading import Thread
+from time import time
+
+from flask import Flask
+from flask_identity_client.application import blueprint
+from flask_identity_client.views import PWRemoteApp
+from flask_identity_client.startup_funcs import init_middles, resources_from_middle, user_required
+
+__all__ = ['StubHandler', 'make_app', 'run']
+
+
+USER_DATA = {
+    'uuid': 'a82670c2-027e-4079-b5c7-81f2433041b3',
+    'email': 'johndoe@myfreecomm.com.br',
+    'first_name': 'John',
+    'last_name': 'Doe',
+    'is_active': True,
+    'accounts': [
+        {
+            'uuid': 'd9a795c8-c891-4665-ac63-9d408209be29',
+            'name': 'Test Account',
+            'plan_slug': 'basic',
+        },
+    ],
+}
+
+RESOURCES = { 'resources': [{ 'id': i, 'name': 'resource {0}'.format(i) } for i in range(20)] }
+
+
+#-----------------------------------------------------------------------
+# Stub servers
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    # PassaporteWeb OAuth endpoints, fetch user data and the middle
+    # resources, with keep-alive connections
+
+    protocol_version = 'HTTP/1.1'
+    # the stub must not add Nagle/delayed ACK waits to the numbers
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        path = self.get_path()
+
+        if path == '/sso/initiate/':
+            self.reply(200, 'text/plain',
+                       b'oauth_token=requesttoken&oauth_token_secret=requestsecret&oauth_callback_confirmed=true')
+        elif path == '/sso/token/':
+            self.reply(200, 'text/plain', b'oauth_token=accesstoken&oauth_token_secret=accesssecret')
+        elif path == '/sso/fetchuserdata/':
+            self.reply(200, 'application/json', json.dumps(USER_DATA).encode('utf-8'))
+        else:
+            self.reply(404, 'text/plain', b'not found')
+
+    def do_GET(self):
+        path = self.get_path()
+        body = json.dumps(RESOURCES).encode('utf-8')
+
+        if path == '/resources/fresh/':
+            self.reply(200, 'application/json', body, Expires=formatdate(time() + 600, usegmt=True))
+        elif path == '/resources/revalidate/':
+            if self.headers.get('If-None-Match') == '"v1"':
+                self.reply(304, None, b'', ETag='"v1"', Expires=formatdate(0, usegmt=True))
+            else:
+                self.reply(200, 'application/json', body, ETag='"v1"', Expires=formatdate(0, usegmt=True))
+        elif path == '/resources/expired/':
+            self.reply(200, 'application/json', body, Expires=formatdate(0, usegmt=True))
+        else:
+            self.reply(404, 'text/plain', b'not found')
+
+    def get_path(self):
+        # views.index joins HOST and FETCH_USER_DATA_PATH with a slash
+        return '/' + self.path.partition('?')[0].lstrip('/')
+
+    def reply(self, status, content_type, body, **headers):
+        self.send_response(status)
+        if content_type:
+            self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingTCPServer):
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.thread = Thread(target=self.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        return 'http://{0}:{1}'.format(*self.server_address)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+#-----------------------------------------------------------------------
+# Application
+
+def make_app(host):
+    app = Flask(__name__)
+    app.config.update(
+        DEBUG = False,
+        SECRET_KEY = b'bench',
+        ENTRYPOINT = 'index',
+        PASSAPORTE_WEB = {
+            'HOST': host,
+            'CONSUMER_TOKEN': '295KkblCDT',
+            'CONSUMER_SECRET': 'EeAlpeFt6VteErylmwkCtLZ9qHtpomgG',
+            'REQUEST_TOKEN_PATH': '/sso/initiate/',
+            'AUTHORIZATION_PATH': '/sso/authorize/',
+            'ACCESS_TOKEN_PATH': '/sso/token/',
+            'FETCH_USER_DATA_PATH': '/sso/fetchuserdata/',
+        },
+    )
+
+    for name in ('fresh', 'revalidate', 'expired'):
+        settings_key = 'MIDDLE_{0}'.format(name.upper())
+        app.config[settings_key] = {
+            'TOKEN': 'X',
+            'SECRET': 'YWRzZmFkc2ZmZGFzZA',
+            'HOST': host,
+            'PATH': '/resources/{0}/'.format(name),
+        }
+        app.add_url_rule('/{0}'.format(name), name, resources_view(resources_from_middle(settings_key)))
+    init_middles(app, 'MIDDLE_FRESH', 'MIDDLE_REVALIDATE', 'MIDDLE_EXPIRED')
+
+    @app.route('/')
+    def index():
+        return user_required() or 'OK'
+
+    app.register_blueprint(blueprint, url_prefix='/sso')
+    return app
+
+
+def resources_view(startup_func):
+    def view():
+        return user_required() or startup_func() or 'OK'
+    return view
+
+
+#-----------------------------------------------------------------------
+# Scenarios
+
+def login(client):
+    # login, authorized and index, as the browser would do
+    response = client.get('/sso/login')
+    assert response.status_code == 302, response.status_code
+    response = client.get('/sso/callback?oauth_token=requesttoken&oauth_verifier=verifier')
+    assert response.status_code == 302, response.status_code
+    response = client.get('/sso/')
+    assert response.status_code == 302, response.status_code
+
+
+def get(client, url):
+    response = client.get(url)
+    assert response.status_code == 200, (url, response.status_code)
+
+
+def cold(app):
+    # a new session: the whole login and the first resources request
+    def op():
+        client = app.test_client()
+        login(client)
+        get(client, '/fresh')
+    return op
+
+
+def warm(app):
+    # logged in with resources not expired yet: no remote calls
+    client = app.test_client()
+    login(client)
+    get(client, '/fresh')
+    return lambda: get(client, '/fresh')
+
+
+def revalidate(app):
+    # expired resources with ETag: 304 from the middle
+    client = app.test_client()
+    login(client)
+    get(client, '/revalidate')
+    return lambda: get(client, '/revalidate')
+
+
+def expired(app):
+    # expired resources without ETag: the middle sends everything again
+    client = app.test_client()
+    login(client)
+    get(client, '/expired')
+    return lambda: get(client, '/expired')
+
+
+SCENARIOS = [('cold', cold), ('warm', warm), ('revalidate', revalidate), ('expired', expired)]
+
+
+#-----------------------------------------------------------------------
+# Runner
+
+def measure(op, iterations, warmup=10):
+    for _ in range(warmup):
+        op()
+
+    latencies = []
+    started = time()
+    for _ in range(iterations):
+        begin = time()
+        op()
+        latencies.append(time() - begin)
+    elapsed = time() - started
+
+    latencies.sort()
+    percentile = lambda fraction: latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] * 1000
+    return {
+        'iterations': iterations,
+        'throughput': iterations / elapsed,
+        'p50': percentile(.5),
+        'p90': percentile(.9),
+        'p99': percentile(.99),
+        'max': latencies[-1] * 1000,
+    }
+
+
+def run(iterations=200, scenarios=None):
+    results = []
+    with StubServer() as server:
+        app = make_app(server.url)
+        for name, scenario in SCENARIOS:
+            if scenarios and name not in scenarios:
+                continue
+            results.append((name, measure(scenario(app), iterations)))
+        # closes the keep-alive connections before the server goes down
+        PWRemoteApp.get_instance(app).pool.clear()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Flask-IdentityClient request path benchmark')
+    parser.add_argument('-n', '--iterations', type=int, default=200)
+    parser.add_argument('--json', action='store_true', help='machine readable output')
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help=', '.join(name for name, _ in SCENARIOS))
+    args = parser.parse_args(argv)
+
+    results = run(args.iterations, args.scenarios)
+
+    if args.json:
+        print(json.dumps(dict(results), indent=2, sort_keys=True))
+        return
+
+    print('{0:<12} {1:>10} {2:>9} {3:>9} {4:>9} {5:>9}'.format('scenario', 'ops/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+    for name, result in results:
+        print('{0:<12} {throughput:>10.1f} {p50:>9.2f} {p90:>9.2f} {p99:>9.2f} {max:>9.2f}'.format(name, **result))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
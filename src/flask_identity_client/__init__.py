@@ -6,3 +6,4 @@ __all__ = ['blueprint']
 
 from .application import blueprint
 from .views import *
+from .middle_views import *
@@ -0,0 +1,90 @@
+# coding: UTF-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from threading import Lock
+from time import time
+from urllib import urlencode
+from werkzeug.exceptions import HTTPException, default_exceptions
+from flask import current_app as app, session
+from .shared import make_cache
+from .views import PWRemoteApp
+from . import signals
+
+__all__ = ['iter_accounts', 'account_uuids', 'get_accounts', 'invalidate']
+
+
+# the user's accounts from PASSAPORTE_WEB['FETCH_ACCOUNTS'], on demand,
+# page by page; each page is cached for ACCOUNTS_TTL seconds
+
+def iter_accounts(uuid=None):
+    config = app.config['PASSAPORTE_WEB']
+    uuid = uuid or session['user_data']['uuid']
+    page_size = config.get('ACCOUNTS_PAGE_SIZE', 50)
+    ttl = config.get('ACCOUNTS_TTL', 300)
+    cache = get_accounts_cache()
+
+    page = 1
+    while True:
+        # all pages of the user expire together
+        expires, pages = cache.get(uuid) or (time() + ttl, {})
+        key = (page, page_size)
+        if key not in pages:
+            pages = dict(pages)
+            pages[key] = fetch_page(config, uuid, page, page_size)
+            cache.set(uuid, (expires, pages), timeout=expires - time())
+
+        items, has_next = pages[key]
+        for account in items:
+            yield account
+
+        if not has_next:
+            break
+        page += 1
+
+
+def account_uuids(uuid=None):
+    for account in iter_accounts(uuid):
+        if account.get('uuid'):
+            yield account['uuid']
+
+
+def get_accounts(uuid=None):
+    return list(iter_accounts(uuid))
+
+
+def fetch_page(config, uuid, page, page_size):
+    url = '/'.join((config['HOST'], config['FETCH_ACCOUNTS'].format(uuid=uuid)))
+    url = '{0}{1}{2}'.format(url, '&' if '?' in url else '?', urlencode({ 'page': page, 'page_size': page_size }))
+
+    with signals.OutboundCall('fetch_accounts') as call:
+        response = PWRemoteApp.get_instance().get(url)
+        call.result(response.status, response.raw_data)
+
+    if response.status != 200:
+        exc_class = default_exceptions.get(response.status, HTTPException)
+        raise exc_class('unexpected status {0} fetching accounts'.format(response.status))
+
+    data = response.data
+    if isinstance(data, list):
+        # not paginated by the server: the whole list, in one page
+        return data, False
+    items = data.get('items', data.get('results', []))
+    return items, bool(data.get('next'))
+
+
+_cache_lock = Lock()
+
+
+def get_accounts_cache():
+    extension = app.extensions.setdefault('identity_client', {})
+    cache = extension.get('accounts')
+    if cache is None:
+        with _cache_lock:
+            cache = extension.setdefault('accounts', make_cache(
+                'accounts', app.config['PASSAPORTE_WEB'].get('ACCOUNTS_CACHE_SIZE', 1024),
+            ))
+    return cache
+
+
+def invalidate(uuid):
+    get_accounts_cache().delete(uuid)
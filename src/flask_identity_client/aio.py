@@ -0,0 +1,190 @@
+# coding: UTF-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import socket
+from time import time
+from urllib import splithost, splittype
+from urlparse import parse_qs, urljoin, urlsplit
+import oauth2
+from httplib2 import HttpLib2Error, ServerNotFoundError
+try:
+    import trollius as asyncio
+    from trollius import From, Return
+except ImportError:
+    asyncio = None
+try:
+    from flask_oauth import OAuthResponse, OAuthException, parse_response
+except ImportError:
+    from flaskext.oauth import OAuthResponse, OAuthException, parse_response
+from .signals import OutboundCall
+from .startup_funcs import middle_request, parse_resources
+
+__all__ = ['AsyncIdentityClient']
+
+
+coroutine = asyncio.coroutine if asyncio else (lambda f: f)
+
+
+class AsyncIdentityClient(object):
+
+    # coroutine counterpart of PWRemoteApp and make_request, for
+    # applications running on an event loop (requires trollius)
+
+    def __init__(self, config, loop=None, timeout=30):
+        if asyncio is None:
+            raise RuntimeError('AsyncIdentityClient requires trollius')
+
+        self.config = config
+        self.loop = loop or asyncio.get_event_loop()
+        self.timeout = timeout
+        self.consumer = oauth2.Consumer(config['CONSUMER_TOKEN'], config['CONSUMER_SECRET'])
+
+    def expand_url(self, url):
+        return urljoin(self.config['HOST'], url)
+
+    @coroutine
+    def fetch_user_data(self, token):
+        response = yield From(self.request(self.config['FETCH_USER_DATA_PATH'], token=token, method='POST',
+                                           endpoint='fetch_user_data'))
+        raise Return(response.data)
+
+    @coroutine
+    def access_token(self, request_token, verifier):
+        response = yield From(self.request(
+            self.config['ACCESS_TOKEN_PATH'],
+            token = request_token,
+            method = 'POST',
+            body = 'oauth_verifier={0}'.format(verifier),
+            endpoint = 'access_token',
+        ))
+
+        data = parse_response(response.headers, response.raw_data)
+        if response.status != 200:
+            raise OAuthException('Invalid response from passaporte web', data)
+        raise Return(data)
+
+    @coroutine
+    def resources(self, settings, token, current=None):
+        if current and current.expires and current.expires > time():
+            raise Return(current)
+
+        url, headers = middle_request(settings, token[1])
+        if current and current.etag:
+            headers['If-None-Match'] = current.etag
+        elif current and current.last_modified:
+            headers['If-Modified-Since'] = current.last_modified
+
+        response = yield From(self.request(url, token=token, headers=headers, endpoint='middle'))
+        raise Return(parse_resources(response, current, settings.get('MAX_AGE')))
+
+    @coroutine
+    def request(self, url, token=None, method='GET', body='', headers=None, endpoint=None):
+        url, body, headers = self.sign(self.expand_url(url), token, method, body or '', dict(headers or {}))
+
+        with OutboundCall(endpoint or urlsplit(url).path) as call:
+            try:
+                resp, content = yield From(asyncio.wait_for(
+                    self.send(method, url, body, headers),
+                    self.timeout, loop=self.loop,
+                ))
+
+            except socket.gaierror:
+                raise ServerNotFoundError('Unable to find the server at {0}'.format(urlsplit(url).hostname))
+
+            except (EnvironmentError, asyncio.TimeoutError) as exc:
+                raise HttpLib2Error('({0}) {1}'.format(type(exc).__name__, exc))
+
+            call.result(resp['status'], content)
+
+        raise Return(OAuthResponse(resp, content))
+
+    def sign(self, url, token, method, body, headers):
+        # same as oauth2.Client.request
+        token = oauth2.Token(*token) if token else None
+        if method == 'POST':
+            headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+
+        is_form_encoded = headers.get('Content-Type') == 'application/x-www-form-urlencoded'
+        parameters = parse_qs(body) if is_form_encoded and body else None
+
+        req = oauth2.Request.from_consumer_and_token(self.consumer,
+            token = token,
+            http_method = method,
+            http_url = url,
+            parameters = parameters,
+            body = body,
+            is_form_encoded = is_form_encoded,
+        )
+        req.sign_request(oauth2.SignatureMethod_HMAC_SHA1(), self.consumer, token)
+
+        if is_form_encoded:
+            body = req.to_postdata()
+        elif method == 'GET':
+            url = req.to_url()
+        else:
+            schema, rest = splittype(url)
+            host, _ = splithost(rest)
+            headers.update(req.to_header(realm='{0}://{1}'.format(schema, host)))
+
+        return url, body, headers
+
+    @coroutine
+    def send(self, method, url, body, headers):
+        body = body.encode('utf-8') if isinstance(body, unicode) else body
+        parts = urlsplit(url)
+        secure = parts.scheme == 'https'
+        path = parts.path or '/'
+        if parts.query:
+            path = '?'.join((path, parts.query))
+
+        reader, writer = yield From(asyncio.open_connection(
+            parts.hostname, parts.port or (443 if secure else 80),
+            ssl = secure or None,
+            loop = self.loop,
+        ))
+
+        try:
+            head = [
+                '{0} {1} HTTP/1.1'.format(method, path),
+                'Host: {0}'.format(parts.netloc),
+                'Connection: close',
+                'Content-Length: {0}'.format(len(body)),
+            ]
+            head.extend('{0}: {1}'.format(name, value) for name, value in headers.items())
+            writer.write('\r\n'.join(head).encode('latin-1') + b'\r\n\r\n' + body)
+
+            status_line = yield From(reader.readline())
+            resp = { 'status': status_line.split()[1].decode('ascii'), 'content-type': '' }
+            while True:
+                line = yield From(reader.readline())
+                if not line.strip():
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                name, value = name.strip().lower(), value.strip()
+                resp[name] = ', '.join((resp[name], value)) if resp.get(name) else value
+
+            if method == 'HEAD' or resp['status'] in ('204', '304'):
+                content = b''
+            elif resp.get('transfer-encoding', '').lower() == 'chunked':
+                content = yield From(read_chunked(reader))
+            elif 'content-length' in resp:
+                content = yield From(reader.readexactly(int(resp['content-length'])))
+            else:
+                content = yield From(reader.read())
+
+        finally:
+            writer.close()
+
+        raise Return((resp, content))
+
+
+@coroutine
+def read_chunked(reader):
+    chunks = []
+    while True:
+        size = int((yield From(reader.readline())).split(b';')[0], 16)
+        if not size:
+            break
+        chunks.append((yield From(reader.readexactly(size))))
+        yield From(reader.readline())
+    raise Return(b''.join(chunks))
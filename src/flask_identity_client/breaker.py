@@ -0,0 +1,152 @@
+# coding: UTF-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from threading import Lock
+from time import time
+from urlparse import urlsplit
+from httplib2 import HttpLib2Error
+
+__all__ = ['CircuitBreaker', 'CircuitBreakers', 'CircuitOpenError']
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpenError(HttpLib2Error):
+    pass
+
+
+class CircuitBreaker(object):
+
+    # opens after `threshold` consecutive failures; after `reset_timeout`
+    # seconds lets `probes` calls through (half-open), closing again on
+    # the first successful probe. before_call returns a probe token, to
+    # be given back to success or failure: only probes of the current
+    # half-open period release their slot and decide the state
+
+    def __init__(self, name, threshold=5, reset_timeout=30, probes=1, on_change=None):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.probes = probes
+        self.on_change = on_change
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._probing = 0
+        self._half_opened = 0
+        self._lock = Lock()
+
+    def before_call(self):
+        probe = None
+        with self._lock:
+            previous = self.state
+            if self.state == OPEN:
+                if time() - self.opened_at < self.reset_timeout:
+                    raise CircuitOpenError('circuit open for {0}'.format(self.name))
+                self._set_state(HALF_OPEN)
+
+            if self.state == HALF_OPEN:
+                if self._probing >= self.probes:
+                    raise CircuitOpenError('circuit half-open for {0}'.format(self.name))
+                self._probing += 1
+                probe = self._half_opened
+        self._notify(previous)
+        return probe
+
+    def success(self, probe=None):
+        with self._lock:
+            previous = self.state
+            self.failures = 0
+            if self._release(probe):
+                self._set_state(CLOSED)
+        self._notify(previous)
+
+    def failure(self, probe=None):
+        with self._lock:
+            previous = self.state
+            self.failures += 1
+            if self._release(probe) or (self.state == CLOSED and self.failures >= self.threshold):
+                self._set_state(OPEN)
+                self.opened_at = time()
+        self._notify(previous)
+
+    def _release(self, probe):
+        # whether it is a probe of the current half-open period; calls
+        # started before do not change the half-open state
+        if probe is None or probe != self._half_opened or self.state != HALF_OPEN:
+            return False
+        self._probing -= 1
+        return True
+
+    def _set_state(self, state):
+        # every transition starts without probes in flight
+        self.state = state
+        self._probing = 0
+        if state == HALF_OPEN:
+            self._half_opened += 1
+
+    def _notify(self, previous):
+        # outside the lock, so the callback may look at the breaker
+        if self.on_change and self.state != previous:
+            self.on_change(self, previous)
+
+
+class CircuitBreakers(object):
+
+    # one breaker per host (scheme and authority)
+
+    def __init__(self, threshold=5, reset_timeout=30, probes=1, on_change=None):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.probes = probes
+        self.on_change = on_change
+        self._breakers = {}
+        self._lock = Lock()
+
+    def get(self, uri):
+        parts = urlsplit(uri)
+        host = '{0}://{1}'.format(parts.scheme, parts.netloc)
+        try:
+            return self._breakers[host]
+
+        except KeyError:
+            with self._lock:
+                if host not in self._breakers:
+                    self._breakers[host] = CircuitBreaker(host,
+                        threshold = self.threshold,
+                        reset_timeout = self.reset_timeout,
+                        probes = self.probes,
+                        on_change = self.on_change,
+                    )
+                return self._breakers[host]
+
+    def call(self, uri, f, *args, **kwargs):
+        # server errors (5xx) count as failures, as well as exceptions
+        breaker = self.get(uri)
+        probe = breaker.before_call()
+        try:
+            resp, content = f(*args, **kwargs)
+
+        except CircuitOpenError:
+            raise
+
+        except Exception:
+            breaker.failure(probe)
+            raise
+
+        if int(resp.status) >= 500:
+            breaker.failure(probe)
+        else:
+            breaker.success(probe)
+        return resp, content
+
+    def snapshot(self):
+        with self._lock:
+            breakers = list(self._breakers.values())
+        return dict((breaker.name, {
+            'state': breaker.state,
+            'failures': breaker.failures,
+        }) for breaker in breakers)
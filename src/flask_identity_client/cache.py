@@ -0,0 +1,290 @@
+# coding: UTF-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import tempfile
+from collections import OrderedDict
+from functools import wraps
+from hashlib import md5
+from threading import RLock
+from time import time
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+from .resp import RedisClient
+from .singleflight import SingleFlight
+
+__all__ = ['LRUCache', 'FileSystemCache', 'RedisCache', 'memoize']
+
+
+class LRUCache(object):
+
+    # same API as werkzeug.contrib.cache: get, set, delete and clear
+
+    def __init__(self, maxsize=1024, default_timeout=None):
+        self.maxsize = maxsize
+        self.default_timeout = default_timeout
+        self.hits = self.misses = self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = RLock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+
+            if expires is not None and expires <= time():
+                # expired entries are dropped, not evicted
+                self.misses += 1
+                return None
+
+            # reinsert it, so the most recently used key stays at the end
+            self._data[key] = (expires, value)
+            self.hits += 1
+            return value
+
+    def peek(self, key):
+        # as get, but not counted as a hit or miss nor moved to the end
+        with self._lock:
+            expires, value = self._data.get(key, (None, None))
+            if expires is not None and expires <= time():
+                return None
+            return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+
+        with self._lock:
+            self._data.pop(key, None)
+            if timeout is not None and timeout <= 0:
+                # already expired, nothing to store
+                return
+
+            expires = None if timeout is None else time() + timeout
+            self._data[key] = (expires, value)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+            }
+
+    def __len__(self):
+        return len(self._data)
+
+
+def memoize(maxsize=128, ttl=None):
+    # bounded LRU memoization for factories; None is a valid result and
+    # concurrent calls with the same arguments build it only once
+
+    def decorator(f):
+        cache = LRUCache(maxsize=maxsize, default_timeout=ttl)
+        inflight = SingleFlight()
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            key = (args, tuple(sorted(kwargs.items()))) if kwargs else args
+            box = cache.get(key)
+            if box is None:
+                box = inflight.do(key, lambda: populate(key, args, kwargs))
+            return box[0]
+
+        def populate(key, args, kwargs):
+            # built meanwhile by another call? the miss is already counted
+            box = cache.peek(key)
+            if box is None:
+                # boxed, so a None result is not taken as a miss
+                box = (f(*args, **kwargs),)
+                cache.set(key, box)
+            return box
+
+        wrapper.stats = cache.stats
+        wrapper.cache_clear = cache.clear
+        return wrapper
+
+    return decorator
+
+
+class FileSystemCache(object):
+
+    # one file per key, safe to share among processes in the same host.
+    # Every `prune_interval` sets, beyond `threshold` files, the expired
+    # ones are removed, and then the oldest, down to 80% of it. With
+    # threshold=None only the expired ones, as sessions need
+
+    def __init__(self, cache_dir, default_timeout=None, threshold=500, prune_interval=50):
+        self.cache_dir = cache_dir
+        self.default_timeout = default_timeout
+        self.threshold = threshold
+        self.prune_interval = prune_interval
+        self._sets = 0
+        self._delay = 0
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def get(self, key):
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as fd:
+                expires, value = pickle.load(fd)
+
+        except (IOError, OSError, EOFError, pickle.PickleError):
+            return None
+
+        if expires is not None and expires <= time():
+            self._remove(filename)
+            return None
+        return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+
+        filename = self._filename(key)
+        if timeout is not None and timeout <= 0:
+            self._remove(filename)
+            return
+
+        self._prune()
+        expires = None if timeout is None else time() + timeout
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fp:
+            pickle.dump((expires, value), fp, pickle.HIGHEST_PROTOCOL)
+        # atomic, readers never see a partial file
+        os.rename(tmp, filename)
+
+    def delete(self, key):
+        self._remove(self._filename(key))
+
+    def clear(self):
+        for name in os.listdir(self.cache_dir):
+            self._remove(os.path.join(self.cache_dir, name))
+
+    def _filename(self, key):
+        return os.path.join(self.cache_dir, md5(key.encode('utf-8')).hexdigest())
+
+    def _list_dir(self):
+        # entries only, not the temporary files being written
+        return [
+            os.path.join(self.cache_dir, name)
+            for name in os.listdir(self.cache_dir)
+            if not name.endswith('.tmp')
+        ]
+
+    def _prune(self):
+        # amortized: a look at the directory every prune_interval sets,
+        # and reading the entries only when there is something to do;
+        # without a threshold, as many sets as the entries read
+        self._sets += 1
+        if self._sets < max(self.prune_interval, self._delay):
+            return
+        self._sets = 0
+
+        entries = self._list_dir()
+        if self.threshold is not None and len(entries) < self.threshold:
+            return
+
+        now = time()
+        alive = []
+        for filename in entries:
+            try:
+                with open(filename, 'rb') as fd:
+                    expires, _ = pickle.load(fd)
+                mtime = os.path.getmtime(filename)
+            except (IOError, OSError, EOFError, pickle.PickleError):
+                self._remove(filename)
+                continue
+            if expires is not None and expires <= now:
+                self._remove(filename)
+            else:
+                alive.append((mtime, filename))
+
+        if self.threshold is None:
+            self._delay = len(alive)
+            return
+        # over the threshold: the least recently written go, leaving room
+        # for a fifth of it before the next read
+        for _, filename in sorted(alive)[:len(alive) - self.threshold * 4 // 5]:
+            self._remove(filename)
+
+    def _remove(self, filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+
+class RedisCache(object):
+
+    def __init__(self, host='localhost', port=6379, db=0, password=None,
+                 key_prefix='', default_timeout=300, client=None):
+        self.client = client or RedisClient(host=host, port=port, db=db, password=password)
+        self.key_prefix = key_prefix
+        self.default_timeout = default_timeout
+
+    def get(self, key):
+        value = self.client.get(self.key_prefix + key)
+        return None if value is None else pickle.loads(value)
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+
+        key = self.key_prefix + key
+        if timeout is not None and timeout <= 0:
+            self.client.delete(key)
+            return
+
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if timeout is None:
+            self.client.set(key, value)
+        else:
+            # Redis expiration has one second resolution
+            self.client.setex(key, max(int(timeout), 1), value)
+
+    def delete(self, key):
+        self.client.delete(self.key_prefix + key)
+
+    def clear(self):
+        if not self.key_prefix:
+            # the whole database is ours
+            self.client.execute('FLUSHDB')
+            return
+
+        # only the keys under the prefix, the database may be shared
+        pattern = redis_escape(self.key_prefix) + '*'
+        cursor = b'0'
+        while True:
+            cursor, keys = self.client.execute('SCAN', cursor, 'MATCH', pattern, 'COUNT', 500)
+            if keys:
+                self.client.delete(*keys)
+            if cursor == b'0':
+                break
+
+
+def redis_escape(value):
+    # glob-style pattern matching only `value`
+    for char in '\\*?[]':
+        value = value.replace(char, '\\' + char)
+    return value
@@ -0,0 +1,72 @@
+# coding: UTF-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from hmac import compare_digest
+from time import time
+from flask import abort, current_app as app, jsonify, request
+from .application import blueprint
+from .resp import to_bytes
+from .startup_funcs import MAX_AGE, Resources, get_resources_cache, get_tombstones
+
+__all__ = []
+
+
+@blueprint.route('/middles/<settings_key>/invalidate', methods=['POST'])
+def invalidate(settings_key):
+    # the middle service, with its own TOKEN and SECRET, sends a batch:
+    #
+    #   {
+    #       "secrets": ["<token secret>", ...],
+    #       "etags": ["<etag>", ...],
+    #       "replace": [{ "secret": "...", "data": ..., "etag": "...", "max_age": 300 }, ...]
+    #   }
+    settings = app.config.get(settings_key)
+    if not isinstance(settings, dict) or not settings.get('PUSH_INVALIDATION'):
+        abort(404)
+
+    auth = request.authorization
+    if not auth or not all([  # both compared, in constant time
+        compare_digest(to_bytes(auth.username or ''), to_bytes(settings['TOKEN'])),
+        compare_digest(to_bytes(auth.password or ''), to_bytes(settings['SECRET'])),
+    ]):
+        response = jsonify(error='unauthorized')
+        response.status_code = 401
+        response.headers['WWW-Authenticate'] = 'Basic realm="{0}"'.format(settings_key)
+        return response
+
+    batch = request.get_json(force=True, silent=True)
+    if not isinstance(batch, dict):
+        abort(400)
+    secrets = batch.get('secrets') or []
+    etags = batch.get('etags') or []
+    replace = batch.get('replace') or []
+    if not all(isinstance(value, list) for value in (secrets, etags, replace)) \
+            or not all(isinstance(value, basestring) for value in secrets + etags) \
+            or not all(isinstance(item, dict) and isinstance(item.get('secret'), basestring)
+                       and isinstance(item.get('max_age', 0), (int, long, float)) for item in replace):
+        abort(400)
+
+    cache = get_resources_cache(settings_key)
+    tombstones = get_tombstones(settings_key)
+    # long enough for every copy, even stale ones, to be gone
+    timeout = settings.get('MAX_AGE', MAX_AGE) \
+            + max(settings.get('STALE_WHILE_REVALIDATE') or 0, settings.get('STALE_IF_ERROR') or 0)
+
+    for secret in secrets + [item['secret'] for item in replace]:
+        tombstones.set('secret:' + secret, True, timeout=timeout)
+        if cache is not None:
+            cache.delete(secret)
+    for etag in etags:
+        # cached entries are found by secret only, so they are checked when read
+        tombstones.set('etag:' + etag, True, timeout=timeout)
+
+    replaced = 0
+    if cache is not None:
+        for item in replace:
+            max_age = min(item.get('max_age') or 0, settings.get('MAX_AGE', MAX_AGE))
+            if max_age > 0:
+                cache.set(item['secret'], Resources(item.get('data'), item.get('etag'), time() + max_age),
+                          timeout=max_age)
+                replaced += 1
+
+    return jsonify(secrets=len(secrets), etags=len(etags), replaced=replaced)
@@ -0,0 +1,138 @@
+# coding: UTF-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from threading import Lock, local
+from time import time
+
+__all__ = ['ConnectionPool', 'PooledConnections', 'PooledHttpMixin']
+
+
+class ConnectionPool(object):
+
+    # keep-alive connections by httplib2 connection key (scheme:authority)
+
+    def __init__(self, maxsize=4, idle_timeout=30):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._lock = Lock()
+
+    def acquire(self, key):
+        stale = []
+        conn = None
+
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                limit = time() - self.idle_timeout
+                while idle and idle[0][0] <= limit:
+                    stale.append(idle.pop(0)[1])
+                if idle:
+                    # the most recently used is the most likely to be alive
+                    conn = idle.pop()[1]
+
+        for old in stale:
+            old.close()
+        return conn
+
+    def release(self, key, conn):
+        if getattr(conn, 'sock', None) is None:
+            # closed by httplib2 after an error or by the server
+            return
+
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append((time(), conn))
+                return
+
+        conn.close()
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+
+        for conns in idle.values():
+            for _, conn in conns:
+                conn.close()
+
+
+class PooledConnections(object):
+
+    # replaces httplib2.Http.connections: connections are borrowed from
+    # the pool when needed and given back when the request is done;
+    # thread-local, so the same client may be used by many threads
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._local = local()
+
+    @property
+    def borrowed(self):
+        try:
+            return self._local.borrowed
+        except AttributeError:
+            borrowed = self._local.borrowed = {}
+            return borrowed
+
+    def __contains__(self, key):
+        borrowed = self.borrowed
+        if key not in borrowed:
+            conn = self.pool.acquire(key)
+            if conn is None:
+                return False
+            borrowed[key] = conn
+        return True
+
+    def __getitem__(self, key):
+        return self.borrowed[key]
+
+    def __setitem__(self, key, conn):
+        self.borrowed[key] = conn
+
+    def __delitem__(self, key):
+        del self.borrowed[key]
+
+    def call(self, f, *args, **kwargs):
+        try:
+            response = f(*args, **kwargs)
+
+        except:
+            # the connection state is unknown, don't reuse it
+            self.discard()
+            raise
+
+        self.release()
+        return response
+
+    def release(self):
+        borrowed = self.borrowed
+        for key, conn in borrowed.items():
+            self.pool.release(key, conn)
+        borrowed.clear()
+
+    def discard(self):
+        borrowed = self.borrowed
+        for conn in borrowed.values():
+            conn.close()
+        borrowed.clear()
+
+
+class PooledHttpMixin(object):
+
+    # for httplib2.Http subclasses
+
+    def __init__(self, *args, **kwargs):
+        pool = kwargs.pop('pool')
+        self.breakers = kwargs.pop('breakers', None)
+        super(PooledHttpMixin, self).__init__(*args, **kwargs)
+        self.connections = PooledConnections(pool)
+
+    def request(self, uri, *args, **kwargs):
+        return self.guarded(uri, super(PooledHttpMixin, self).request, uri, *args, **kwargs)
+
+    def guarded(self, uri, f, *args, **kwargs):
+        # through the host circuit breaker, if any
+        if self.breakers is None:
+            return self.connections.call(f, *args, **kwargs)
+        return self.breakers.call(uri, self.connections.call, f, *args, **kwargs)
@@ -0,0 +1,139 @@
+# coding: UTF-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import socket
+from threading import local
+
+__all__ = ['RedisClient', 'RedisError']
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisClient(object):
+
+    # minimal Redis protocol (RESP) client, one connection per thread
+
+    def __init__(self, host='localhost', port=6379, db=0, password=None, socket_timeout=None):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.socket_timeout = socket_timeout
+        self._local = local()
+
+    def execute(self, *args):
+        try:
+            return self._execute(self._connection(), args)
+        except socket.error:
+            # stale connection, retry once with a new one
+            self.close()
+            return self._execute(self._connection(), args)
+
+    def get(self, key):
+        return self.execute('GET', key)
+
+    def setex(self, key, timeout, value):
+        return self.execute('SETEX', key, timeout, value)
+
+    def set(self, key, value):
+        return self.execute('SET', key, value)
+
+    def delete(self, *keys):
+        return self.execute('DEL', *keys)
+
+    def publish(self, channel, message):
+        return self.execute('PUBLISH', channel, message)
+
+    def listen(self, *channels):
+        # subscriber mode needs a connection of its own: yields
+        # (kind, channel, payload), e.g. (b'message', channel, message)
+        fd = self._connect()
+        try:
+            fd.write(encode_command(('SUBSCRIBE',) + channels))
+            fd.flush()
+            while True:
+                kind, channel, payload = read_reply(fd)
+                yield kind, channel, payload
+        finally:
+            fd.close()
+
+    def close(self):
+        fd = getattr(self._local, 'fd', None)
+        self._local.fd = None
+        if fd is not None:
+            try:
+                fd.close()
+            except socket.error:
+                pass
+
+    def _connection(self):
+        fd = getattr(self._local, 'fd', None)
+        if fd is None:
+            fd = self._local.fd = self._connect()
+        return fd
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), self.socket_timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        fd = sock.makefile('rwb')
+        sock.close()  # the file object keeps the connection open
+
+        if self.password:
+            self._execute(fd, ('AUTH', self.password))
+        if self.db:
+            self._execute(fd, ('SELECT', self.db))
+        return fd
+
+    def _execute(self, fd, args):
+        fd.write(encode_command(args))
+        fd.flush()
+        return read_reply(fd)
+
+
+#-----------------------------------------------------------------------
+# Protocol
+
+def encode_command(args):
+    args = [to_bytes(arg) for arg in args]
+    chunks = [b'*' + str(len(args)).encode('ascii') + b'\r\n']
+    for arg in args:
+        chunks.append(b'$' + str(len(arg)).encode('ascii') + b'\r\n')
+        chunks.append(arg)
+        chunks.append(b'\r\n')
+    return b''.join(chunks)
+
+
+def read_reply(fd):
+    line = fd.readline()
+    if not line:
+        raise socket.error('connection closed by server')
+
+    kind, payload = line[:1], line[1:-2]
+    if kind == b'+':
+        return payload
+    if kind == b'-':
+        raise RedisError(payload.decode('utf-8', 'replace'))
+    if kind == b':':
+        return int(payload)
+    if kind == b'$':
+        length = int(payload)
+        if length < 0:
+            return None
+        data = fd.read(length + 2)
+        return data[:-2]
+    if kind == b'*':
+        length = int(payload)
+        if length < 0:
+            return None
+        return [read_reply(fd) for _ in range(length)]
+    raise RedisError('unknown reply: {0!r}'.format(line))
+
+
+def to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value).encode('ascii')
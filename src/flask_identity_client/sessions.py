@@ -0,0 +1,264 @@
+# coding: UTF-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import re
+import zlib
+from base64 import b64decode, b64encode
+from datetime import datetime
+from uuid import UUID, uuid4
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+from itsdangerous import BadData, BadPayload, TimedSerializer, base64_decode, base64_encode
+from werkzeug.datastructures import CallbackDict
+from werkzeug.exceptions import Unauthorized
+from werkzeug.http import http_date, parse_date
+from flask import Markup
+from flask.sessions import SessionInterface, SecureCookieSessionInterface, SessionMixin, total_seconds
+from .startup_funcs import Resources
+
+__all__ = [
+    'ServerSideSession', 'ServerSideSessionInterface',
+    'CompactSerializer', 'CompactSessionInterface',
+]
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.previous_sid = None
+
+    def regenerate(self):
+        # a new id for the same data, e.g. on login, against fixation;
+        # the old one is removed from the store on save
+        if self.previous_sid is None:
+            self.previous_sid = self.sid
+        self.sid = uuid4().hex
+        self.new = True
+        self.modified = True
+
+
+class PickleSerializer(object):
+
+    def dumps(self, value):
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, value):
+        return pickle.loads(value)
+
+
+# what the sessions of this blueprint look like, as tagged JSON: the
+# starting window of the compressor, so the keys cost almost nothing.
+# Never change it, sessions compressed with it would become unreadable;
+# a new one needs a new kind in CompactSerializer
+PRESET = (
+    '{"access_token":{" t":["",""]},"middle_resources":{},"resources":{" r":[{},"",null]},'
+    '"user_data":{"accounts":[],"email":"","first_name":"","full_name":"","last_name":"","uuid":""}}'
+).encode('utf-8')
+
+
+def primed(level):
+    # raw deflate streams that already went through PRESET; the compressed
+    # PRESET is dropped, the decompressor is fed with it again
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    prefix = compressor.compress(PRESET) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    decompressor.decompress(prefix)
+    return compressor, decompressor
+
+
+class CompactSerializer(object):
+
+    # tagged JSON, like Flask's, that also keeps Resources and the
+    # Unauthorized marker; compressed against PRESET when it pays off
+    # and prefixed with a version tag, so the format may change later
+
+    version = b'1'
+    preset = b'd'
+    compressed = b'z'  # plain zlib, still read
+    plain = b'j'
+
+    def __init__(self, level=9):
+        self.level = level
+        self._compressor, self._decompressor = primed(level)
+
+    def dumps(self, value):
+        data = json.dumps(tag(value), separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+        compressor = self._compressor.copy()
+        compressed = compressor.compress(data) + compressor.flush()
+        if len(compressed) < len(data):
+            return self.version + self.preset + compressed
+        return self.version + self.plain + data
+
+    def loads(self, value):
+        version, kind, data = value[:1], value[1:2], value[2:]
+        if version != self.version or kind not in (self.preset, self.compressed, self.plain):
+            raise ValueError('unknown session format')
+        if kind == self.preset:
+            decompressor = self._decompressor.copy()
+            data = decompressor.decompress(data) + decompressor.flush()
+        elif kind == self.compressed:
+            data = zlib.decompress(data)
+        return json.loads(data.decode('utf-8'), object_hook=untag)
+
+
+class CompactSigningSerializer(TimedSerializer):
+
+    # itsdangerous' URL-safe serializer without its zlib: the payload
+    # is compressed already
+
+    def dump_payload(self, obj):
+        return base64_encode(super(CompactSigningSerializer, self).dump_payload(obj))
+
+    def load_payload(self, payload):
+        try:
+            data = base64_decode(payload)
+        except Exception as exc:
+            raise BadPayload('Could not base64 decode the payload', original_error=exc)
+        return super(CompactSigningSerializer, self).load_payload(data)
+
+
+def tag(value):
+    if isinstance(value, Resources):
+        fields = [tag(value.data), value.etag, value.expires]
+        if value.last_modified or value.must_revalidate:
+            # left out when they have the default values
+            fields += [value.last_modified, value.must_revalidate]
+        return { ' r': fields }
+    elif value is Unauthorized:
+        return { ' U': 0 }
+    elif isinstance(value, tuple):
+        return { ' t': [tag(item) for item in value] }
+    elif isinstance(value, list):
+        return [tag(item) for item in value]
+    elif isinstance(value, dict):
+        return dict((key, tag(item)) for key, item in value.items())
+    elif isinstance(value, UUID):
+        return { ' u': value.hex }
+    elif isinstance(value, datetime):
+        return { ' d': http_date(value) }
+    elif callable(getattr(value, '__html__', None)):
+        return { ' m': unicode(value.__html__()) }
+    elif isinstance(value, bytes):
+        try:
+            return value.decode('ascii')
+        except UnicodeError:
+            return { ' b': b64encode(value).decode('ascii') }
+    return value
+
+
+def untag(obj):
+    if len(obj) != 1:
+        return obj
+    key, value = next(iter(obj.items()))
+    if key == ' r':
+        return Resources(*value)
+    elif key == ' U':
+        return Unauthorized
+    elif key == ' t':
+        return tuple(value)
+    elif key == ' u':
+        return UUID(value)
+    elif key == ' d':
+        return parse_date(value)
+    elif key == ' m':
+        return Markup(value)
+    elif key == ' b':
+        return b64decode(value)
+    return obj
+
+
+class CompactSessionInterface(SecureCookieSessionInterface):
+
+    # signed cookie sessions with CompactSerializer
+
+    salt = 'compact-cookie-session'
+    serializer = CompactSerializer()
+
+    def get_signing_serializer(self, app):
+        if not app.secret_key:
+            return None
+        return CompactSigningSerializer(app.secret_key,
+            salt = self.salt,
+            serializer = self.serializer,
+            signer_kwargs = {
+                'key_derivation': self.key_derivation,
+                'digest_method': self.digest_method,
+            },
+        )
+
+    def open_session(self, app, request):
+        try:
+            return super(CompactSessionInterface, self).open_session(app, request)
+        except BadData:
+            # valid signature, but unknown format
+            return self.session_class()
+
+
+class ServerSideSessionInterface(SessionInterface):
+
+    # the cookie holds only the session id, data is kept in the store,
+    # which may be any object with werkzeug.contrib.cache API (get, set
+    # and delete), like LRUCache, FileSystemCache or RedisCache
+
+    session_class = ServerSideSession
+    serializer = PickleSerializer()
+    key_prefix = 'session:'
+    valid_sid = re.compile(r'^[0-9a-f]{32}$').match
+
+    def __init__(self, store, key_prefix=None, serializer=None):
+        self.store = store
+        if key_prefix is not None:
+            self.key_prefix = key_prefix
+        if serializer is not None:
+            self.serializer = serializer
+
+    def generate_sid(self):
+        return uuid4().hex
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+        if not sid or not self.valid_sid(sid):
+            return self.session_class(sid=self.generate_sid(), new=True)
+
+        data = self.store.get(self.key_prefix + sid)
+        if data is None:
+            # never adopt an id chosen by the client
+            return self.session_class(sid=self.generate_sid(), new=True)
+
+        return self.session_class(self.serializer.loads(data), sid=sid)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        key = self.key_prefix + session.sid
+
+        if session.previous_sid is not None:
+            self.store.delete(self.key_prefix + session.previous_sid)
+
+        if not session:
+            if session.modified:
+                self.store.delete(key)
+                response.delete_cookie(app.session_cookie_name, domain=domain, path=path)
+            return
+
+        if session.modified or session.new:
+            timeout = total_seconds(app.permanent_session_lifetime)
+            self.store.set(key, self.serializer.dumps(dict(session)), timeout=timeout)
+
+        if session.new or session.permanent:
+            response.set_cookie(app.session_cookie_name, session.sid,
+                                expires = self.get_expiration_time(app, session),
+                                httponly = self.get_cookie_httponly(app),
+                                domain = domain,
+                                path = path,
+                                secure = self.get_cookie_secure(app))
@@ -0,0 +1,318 @@
+# coding: UTF-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import logging
+import os
+import socket
+from threading import Event, Lock, Thread
+from time import time
+from flask import current_app as app
+from .cache import LRUCache
+from .resp import RedisClient, RedisError
+
+__all__ = ['SharedCache', 'SharedCaches', 'FileBus', 'RedisBus', 'make_cache']
+
+
+logger = logging.getLogger(__name__)
+
+# a local mark for keys known to be absent from the store
+MISSING = object()
+
+
+#-----------------------------------------------------------------------
+# Caches
+
+class SharedCache(object):
+
+    # a local LRUCache in front of a store shared by all processes
+    # (FileSystemCache, RedisCache); deletions are broadcast on the bus,
+    # so every process drops its local copy. Local copies live at most
+    # local_ttl seconds, which bounds staleness if a message is lost.
+    # With cache_misses, absent keys are remembered locally as well, and
+    # sets are broadcast too, for caches mostly looked up in vain. A
+    # failing store is logged and bypassed: reads miss, writes are lost
+
+    def __init__(self, store, bus=None, name='', maxsize=1024, local_ttl=5, cache_misses=False):
+        self.store = store
+        self.bus = bus
+        self.name = name
+        self.local = LRUCache(maxsize=maxsize)
+        self.local_ttl = local_ttl
+        self.cache_misses = cache_misses
+        self._prefix = '{0}:'.format(name) if name else ''
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is MISSING:
+            return None
+        if value is not None:
+            return value
+
+        try:
+            entry = self.store.get(self._prefix + key)
+        except (EnvironmentError, RedisError) as exc:
+            logger.error('(%s) %s', type(exc).__name__, exc)
+            return None
+
+        if entry is None:
+            if self.cache_misses:
+                self.local.set(key, MISSING, timeout=self.local_ttl)
+            return None
+        expires, value = entry
+        self._set_local(key, value, expires)
+        return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is not None and timeout <= 0:
+            self.delete(key)
+            return
+
+        expires = None if timeout is None else time() + timeout
+        self._call_store('set', self._prefix + key, (expires, value), timeout=timeout)
+        self._set_local(key, value, expires)
+        if self.cache_misses:
+            # the other processes may remember it as missing
+            self._publish(key)
+
+    def delete(self, key):
+        self.local.delete(key)
+        self._call_store('delete', self._prefix + key)
+        self._publish(key)
+
+    def clear(self):
+        self.local.clear()
+        self._call_store('clear')
+        self._publish(None)
+
+    def invalidated(self, key):
+        # from the bus: None clears everything
+        if key is None:
+            self.local.clear()
+        else:
+            self.local.delete(key)
+
+    def _set_local(self, key, value, expires):
+        timeout = self.local_ttl
+        if expires is not None:
+            timeout = min(timeout, expires - time())
+        if timeout > 0:
+            self.local.set(key, value, timeout=timeout)
+
+    def _call_store(self, method, *args, **kwargs):
+        try:
+            getattr(self.store, method)(*args, **kwargs)
+        except (EnvironmentError, RedisError) as exc:
+            # the shared copy is lost, the local one still holds
+            logger.error('(%s) %s', type(exc).__name__, exc)
+
+    def _publish(self, key):
+        if self.bus is None:
+            return
+        try:
+            self.bus.publish(self.name, key)
+        except (EnvironmentError, RedisError) as exc:
+            # the other processes will notice after local_ttl
+            logger.error('(%s) %s', type(exc).__name__, exc)
+
+
+class SharedCaches(object):
+
+    # one SharedCache per name over the same store and bus, for
+    # PASSAPORTE_WEB['SHARED_CACHE']
+
+    def __init__(self, store, bus=None, local_ttl=5):
+        self.store = store
+        self.bus = bus
+        self.local_ttl = local_ttl
+        self._caches = {}
+        self._lock = Lock()
+
+    def cache(self, name, maxsize=1024, cache_misses=False):
+        with self._lock:
+            if not self._caches and self.bus is not None:
+                # on first use, so the listener starts in the worker
+                # process, not in a master that forks afterwards
+                self.bus.subscribe(self.invalidated)
+            cache = self._caches.get(name)
+            if cache is None:
+                cache = self._caches[name] = SharedCache(self.store, self.bus,
+                    name = name,
+                    maxsize = maxsize,
+                    local_ttl = self.local_ttl,
+                    cache_misses = cache_misses,
+                )
+            return cache
+
+    def invalidated(self, name, key):
+        cache = self._caches.get(name)
+        if cache is not None:
+            cache.invalidated(key)
+
+
+def make_cache(name, maxsize, cache_misses=False):
+    # the blueprint's caches: shared by all processes with SHARED_CACHE,
+    # local to the process otherwise
+    shared = app.config['PASSAPORTE_WEB'].get('SHARED_CACHE')
+    if shared is None:
+        return LRUCache(maxsize=maxsize)
+    return shared.cache(name, maxsize, cache_misses=cache_misses)
+
+
+#-----------------------------------------------------------------------
+# Invalidation buses
+
+def encode_message(name, key):
+    return json.dumps([name, key]).encode('utf-8')
+
+
+def decode_message(message):
+    name, key = json.loads(message.decode('utf-8'))
+    return name, key
+
+
+class Bus(object):
+
+    # publish(name, key) reaches the callbacks of every process,
+    # including the publisher; listening starts on the first subscribe
+
+    def __init__(self):
+        self._callbacks = []
+        self._lock = Lock()
+        self._stopped = Event()
+        self._thread = None
+
+    def subscribe(self, callback):
+        with self._lock:
+            self._callbacks.append(callback)
+            if self._thread is None:
+                self._start()
+                self._thread = Thread(target=self._listen, name=type(self).__name__)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def close(self, timeout=1):
+        self._wake()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _wake(self):
+        self._stopped.set()
+
+    def dispatch(self, message):
+        try:
+            name, key = decode_message(message)
+        except ValueError:
+            return
+        for callback in list(self._callbacks):
+            try:
+                callback(name, key)
+            except Exception:
+                logger.exception('invalidation callback failed')
+
+    def _start(self):
+        pass
+
+
+class FileBus(Bus):
+
+    # messages appended to a file shared by the processes of the same
+    # host, polled every `interval` seconds; the file is emptied when it
+    # grows beyond max_size
+
+    def __init__(self, path, interval=.5, max_size=1024 * 1024):
+        super(FileBus, self).__init__()
+        self.path = path
+        self.interval = interval
+        self.max_size = max_size
+        self._offset = 0
+
+    def publish(self, name, key):
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size > self.max_size:
+                os.ftruncate(fd, 0)
+            # a single write in append mode is not interleaved with others
+            os.write(fd, encode_message(name, key) + b'\n')
+        finally:
+            os.close(fd)
+
+    def _start(self):
+        # only what is published from now on
+        self._offset = self._size()
+
+    def _listen(self):
+        while not self._stopped.wait(self.interval):
+            self.poll()
+
+    def poll(self):
+        size = self._size()
+        if size < self._offset:
+            # emptied by a publisher
+            self._offset = 0
+        if size == self._offset:
+            return
+
+        try:
+            with open(self.path, 'rb') as fd:
+                fd.seek(self._offset)
+                data = fd.read(size - self._offset)
+        except (IOError, OSError):
+            return
+
+        # a line being written is read on the next poll
+        data = data[:data.rfind(b'\n') + 1]
+        self._offset += len(data)
+        for line in data.splitlines():
+            self.dispatch(line)
+
+    def _size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+
+class RedisBus(Bus):
+
+    # messages on a Redis pub/sub channel, with a dedicated connection
+    # for listening, reopened after failures
+
+    def __init__(self, host='localhost', port=6379, db=0, password=None,
+                 channel='flask-identity-client', client=None, retry_interval=1):
+        super(RedisBus, self).__init__()
+        self.client = client or RedisClient(host=host, port=port, db=db, password=password)
+        self.channel = channel
+        self.retry_interval = retry_interval
+        self.listening = Event()
+
+    def publish(self, name, key):
+        self.client.publish(self.channel, encode_message(name, key))
+
+    def _wake(self):
+        super(RedisBus, self)._wake()
+        try:
+            # wakes the listener up
+            self.client.publish(self.channel, b'')
+        except (EnvironmentError, RedisError):
+            pass
+
+    def _listen(self):
+        while not self._stopped.is_set():
+            replies = self.client.listen(self.channel)
+            try:
+                for kind, _, payload in replies:
+                    if self._stopped.is_set():
+                        break
+                    if kind == b'subscribe':
+                        self.listening.set()
+                    elif kind == b'message' and payload:
+                        self.dispatch(payload)
+
+            except (socket.error, RedisError) as exc:
+                self.listening.clear()
+                logger.error('(%s) %s', type(exc).__name__, exc)
+                self._stopped.wait(self.retry_interval)
+
+            finally:
+                replies.close()
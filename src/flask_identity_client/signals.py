@@ -1,9 +1,190 @@
 # coding: UTF-8
 from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+from copy import deepcopy
+from hashlib import sha1
+from threading import Lock
+from time import time
+from flask import current_app, has_app_context
 from flask.signals import Namespace
+from .cache import LRUCache
+from .workers import WorkerPool, Full
 
-__all__ = ['update_service_account']
+__all__ = [
+    'update_service_account', 'update_service_account_unchanged', 'outbound_call',
+    'circuit_state', 'token_revoked', 'access_token_ready',
+    'send_update_service_account', 'flush', 'OutboundCall',
+]
 
 
 ns = Namespace()
 update_service_account = ns.signal('update-service-account')
+update_service_account_unchanged = ns.signal('update-service-account-unchanged')
+outbound_call = ns.signal('outbound-call')
+circuit_state = ns.signal('circuit-state')
+token_revoked = ns.signal('token-revoked')
+access_token_ready = ns.signal('access-token-ready')
+
+
+#-----------------------------------------------------------------------
+# Instrumentation
+
+class OutboundCall(object):
+
+    # times a remote call and sends outbound_call with endpoint, status,
+    # duration, size (bytes), cache and error:
+    #
+    #   with OutboundCall('fetch_user_data') as call:
+    #       response = ...
+    #       call.result(response.status, response.raw_data)
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.status = self.content = self.cache = None
+
+    def __enter__(self):
+        self.started = time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        send_outbound_call(self.endpoint, time() - self.started,
+            status = self.status,
+            content = self.content,
+            cache = self.cache,
+            error = exc_type,
+        )
+
+    def result(self, status, content=None, cache=None):
+        self.status = status
+        self.content = content
+        self.cache = cache or ('not-modified' if str(status) == '304' else None)
+
+
+def send_outbound_call(endpoint, duration, status=None, content=None, cache=None, error=None):
+    # cache: None (remote call), 'hit', 'stale' or 'not-modified'
+    if not outbound_call.receivers:
+        return
+
+    outbound_call.send(
+        current_app._get_current_object() if has_app_context() else None,
+        endpoint = endpoint,
+        status = int(status) if isinstance(status, (int, long, basestring)) else None,
+        duration = duration,
+        size = len(content) if isinstance(content, basestring) else None,
+        cache = cache,
+        error = error.__name__ if error else None,
+    )
+
+
+def send_circuit_state(breaker, previous):
+    # host, state ('closed', 'open' or 'half-open'), previous and failures
+    circuit_state.send(
+        current_app._get_current_object() if has_app_context() else None,
+        host = breaker.name,
+        state = breaker.state,
+        previous = previous,
+        failures = breaker.failures,
+    )
+
+
+#-----------------------------------------------------------------------
+# Asynchronous dispatch
+
+_extension_lock = Lock()
+
+
+def send_update_service_account(app, user_data):
+    # with SKIP_UNCHANGED, user data already delivered for the same
+    # uuid fires update_service_account_unchanged instead
+    fingerprints = get_fingerprints(app)
+    if fingerprints is not None:
+        key = user_data.get('uuid')
+        digest = fingerprint(user_data)
+        last = fingerprints.get(key)
+        if last and last[0] == digest:
+            # the accounts as left by the handlers last time
+            user_data['accounts'] = deepcopy(last[1])
+            update_service_account_unchanged.send(app, user_data=user_data)
+            return
+
+        def delivered(accounts):
+            fingerprints.set(key, (digest, accounts), timeout=app.config['PASSAPORTE_WEB'].get('FINGERPRINT_TIMEOUT'))
+    else:
+        delivered = lambda accounts: None
+
+    # with ASYNC_UPDATE, receivers run on a worker pool inside an
+    # application context, so the login redirect doesn't wait for them
+    config = app.config['PASSAPORTE_WEB']
+    if not config.get('ASYNC_UPDATE'):
+        update_service_account.send(app, user_data=user_data)
+        delivered(deepcopy(user_data.get('accounts', [])))
+        return
+
+    # receivers get their own copy, the view goes on with the original
+    accounts = deepcopy(user_data.get('accounts', []))
+    user_data = deepcopy(user_data)
+
+    def dispatch():
+        with app.app_context():
+            update_service_account.send(app, user_data=user_data)
+        delivered(accounts)
+
+    try:
+        get_workers(app).submit(dispatch)
+
+    except Full:
+        # backpressure: the request does the work itself
+        app.logger.getChild(update_service_account.name).warning('update queue is full, running synchronously')
+        update_service_account.send(app, user_data=user_data)
+        delivered(accounts)
+
+
+def flush(app, timeout=None):
+    # waits for the pending updates; False if timed out
+    workers = app.extensions.get('identity_client', {}).get('update_workers')
+    return workers.join(timeout) if workers else True
+
+
+def get_workers(app):
+    extension = app.extensions.setdefault('identity_client', {})
+    workers = extension.get('update_workers')
+    if workers is None:
+        with _extension_lock:
+            workers = extension.get('update_workers')
+            if workers is None:
+                config = app.config['PASSAPORTE_WEB']
+                workers = extension['update_workers'] = WorkerPool(
+                    max_workers = config.get('UPDATE_WORKERS', 2),
+                    max_queue = config.get('UPDATE_QUEUE_SIZE', 256),
+                    name = update_service_account.name,
+                    logger = app.logger.getChild(update_service_account.name),
+                )
+    return workers
+
+
+#-----------------------------------------------------------------------
+# Change detection
+
+def fingerprint(user_data):
+    data = json.dumps(user_data, sort_keys=True, separators=(',', ':'), default=unicode)
+    return sha1(data.encode('utf-8')).hexdigest()
+
+
+def get_fingerprints(app):
+    # last delivered fingerprint and accounts by uuid; FINGERPRINT_STORE
+    # may be any cache (e.g. shared by all processes)
+    config = app.config['PASSAPORTE_WEB']
+    if not config.get('SKIP_UNCHANGED'):
+        return None
+
+    store = config.get('FINGERPRINT_STORE')
+    if store is not None:
+        return store
+
+    extension = app.extensions.setdefault('identity_client', {})
+    store = extension.get('fingerprints')
+    if store is None:
+        with _extension_lock:
+            store = extension.setdefault('fingerprints', LRUCache(maxsize=config.get('FINGERPRINT_CACHE_SIZE', 10000)))
+    return store
@@ -0,0 +1,63 @@
+# coding: UTF-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from threading import Event, Lock
+
+__all__ = ['SingleFlight']
+
+
+class SingleFlight(object):
+
+    # concurrent calls with the same key wait for the first one
+    # instead of repeating it
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = Lock()
+
+    def do(self, key, f, timeout=None):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Call()
+
+        if not leader:
+            if call.wait(timeout):
+                return call.result()
+            # the leader is taking too long, go on alone
+            return f()
+
+        try:
+            call.value = f()
+
+        except Exception as exc:
+            call.error = exc
+            raise
+
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        return call.value
+
+    def __contains__(self, key):
+        return key in self._calls
+
+
+class Call(object):
+
+    def __init__(self):
+        self.done = Event()
+        self.value = None
+        self.error = None
+
+    def wait(self, timeout):
+        # Event.wait returns the flag since Python 2.7
+        return self.done.wait(timeout)
+
+    def result(self):
+        if self.error is not None:
+            raise self.error
+        return self.value
@@ -2,106 +2,492 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import urllib
-from functools import wraps, partial
+from functools import partial
 from collections import namedtuple
+from threading import Lock
 from time import time
 from email.utils import parsedate_tz, mktime_tz
 from httplib2 import HttpLib2Error
 from werkzeug.exceptions import Unauthorized, HTTPException, default_exceptions
-from flask import current_app as app, redirect, request, session, url_for, g
-from .views import PWRemoteApp
-
-__all__ = ['user_required', 'resources_from_middle']
+from werkzeug.local import LocalProxy
+from flask import current_app as app, redirect, request, session, url_for, g, Blueprint
+from .breaker import CircuitOpenError
+from .cache import memoize
+from .shared import make_cache
+from .singleflight import SingleFlight
+from .workers import WorkerPool, Full
+from .views import PWRemoteApp, get_access_token, get_user_data_cache
+from . import signals
+
+__all__ = [
+    'user_required', 'require_user', 'current_user_data', 'token_required',
+    'resources_from_middle', 'resources_from_middles', 'init_middles', 'get_resources_cache',
+]
 
 
 #-----------------------------------------------------------------------
 # user_required
 
 def user_required():
-    login_url = url_for('identity_client.index', next=request.url)
-
     user_data = g.user_data = session.get('user_data')
     if not user_data:
-        return redirect(login_url)
+        return redirect(login_url())
+
+
+def login_url():
+    return url_for('identity_client.index', next=request.url)
+
+
+# session['user_data'], read only when used
+current_user_data = LocalProxy(lambda: session.get('user_data'))
+
+
+def require_user(target, exempt=(), check=None):
+    # registers a guard on an application or blueprint; the endpoints in
+    # `exempt`, static files and the identity_client views are let through.
+    # `check` replaces the default test, e.g. token_required
+    exempt = set(exempt)
+    exempt.update((None, 'static'))  # None: no route matched, 404
+    if isinstance(target, Blueprint):
+        exempt.add('{0}.static'.format(target.name))
+    exempt = frozenset(exempt)
+
+    def guard():
+        if request.endpoint in exempt or request.blueprint == 'identity_client':
+            return None
+        if check is not None:
+            return check()
+        if not session.get('user_data'):
+            return redirect(login_url())
+        g.user_data = current_user_data
+
+    target.before_request(guard)
+    return guard
 
 
 #-----------------------------------------------------------------------
-# resources_from_middle
+# token_required
+
+def token_required():
+    # user_required, plus the access token is checked against
+    # ACCESS_TOKEN_VALIDATION, at most once per TOKEN_VALIDATION_TTL
+    response = user_required()
+    if response is not None:
+        return response
+
+    access_token = session.get('access_token')
+    if access_token and is_token_valid(access_token):
+        return None
+
+    # revoked: logged out
+    session.pop('user_data', None)
+    session.pop('access_token', None)
+    g.user_data = None
+    user_data_cache = get_user_data_cache()
+    if access_token and user_data_cache is not None:
+        user_data_cache.delete(access_token[0])
+    if access_token:
+        signals.token_revoked.send(app._get_current_object(), access_token=tuple(access_token))
+
+    return redirect(login_url())
+
+
+def is_token_valid(access_token):
+    config = app.config['PASSAPORTE_WEB']
+    cache = get_validations_cache()
+    key = access_token[0]
+
+    valid = cache.get(key)
+    if valid is not None:
+        return valid
+
+    def validate():
+        url = '/'.join((config['HOST'], config['ACCESS_TOKEN_VALIDATION']))
+        with signals.OutboundCall('token_validation') as call:
+            response = PWRemoteApp.get_instance().get(url)
+            call.result(response.status, response.raw_data)
+
+        if response.status in (401, 403):
+            valid = False
+        elif response.status == 200:
+            valid = True
+        else:
+            raise HTTPException('unexpected status {0}'.format(response.status))
+
+        cache.set(key, valid, timeout=config.get('TOKEN_VALIDATION_TTL', 60))
+        return valid
+
+    try:
+        # requests with the same token share a single validation
+        return _validations.do(key, validate, timeout=config.get('TOKEN_VALIDATION_TIMEOUT', 10))
+
+    except (HttpLib2Error, HTTPException) as exc:
+        # PassaporteWeb is unavailable, don't log everybody out
+        logger = app.logger.getChild(token_required.__name__)
+        logger.error('(%s) %s', type(exc).__name__, exc)
+        # nor ask it again on every request until it's time to try again
+        cache.set(key, True, timeout=config.get('TOKEN_VALIDATION_ERROR_TTL', 5))
+        return True
 
-def single_argument_memoize(f):
-    memo = {}
 
-    @wraps(f)
-    def wrapper(arg):
-        resp = memo.get(arg)
-        if resp is None:
-            resp = memo[arg] = f(arg)
-        return resp
+@signals.token_revoked.connect
+def forget_token(sender, access_token):
+    # logout or revocation: with SHARED_CACHE, every process drops it
+    validations = sender.extensions.get('identity_client', {}).get('validations')
+    if validations is not None:
+        # the deletion is broadcast, the other processes read False next
+        validations.delete(access_token[0])
+        validations.set(access_token[0], False,
+                        timeout=sender.config['PASSAPORTE_WEB'].get('TOKEN_VALIDATION_TTL', 60))
+    resources_caches = sender.extensions.get('identity_client', {}).get('resources', {})
+    for cache in list(resources_caches.values()):
+        cache.delete(access_token[1])
 
-    return wrapper
 
+_validations = SingleFlight()
+_validations_lock = Lock()
 
-@single_argument_memoize
+
+def get_validations_cache():
+    extension = app.extensions.setdefault('identity_client', {})
+    cache = extension.get('validations')
+    if cache is None:
+        with _validations_lock:
+            cache = extension.setdefault('validations', make_cache(
+                'validations', app.config['PASSAPORTE_WEB'].get('TOKEN_VALIDATION_CACHE_SIZE', 1024),
+            ))
+    return cache
+
+
+#-----------------------------------------------------------------------
+# resources_from_middle
+
+MEMOIZE_SIZE = 128
+
+
+@memoize(maxsize=MEMOIZE_SIZE)
 def resources_from_middle(settings_key):
     return partial(_resources_from_middle, settings_key=settings_key)
 
 
 def _resources_from_middle(settings_key):
+    _, oauth_secret = session['access_token']
+    session['resources'] = load_resources(settings_key, oauth_secret, session.get('resources'))
+
+
+@memoize(maxsize=MEMOIZE_SIZE)
+def resources_from_middles(*settings_keys):
+    if not settings_keys:
+        raise ValueError('resources_from_middles needs at least one settings key')
+    return partial(_resources_from_middles, settings_keys=settings_keys)
+
+
+def _resources_from_middles(settings_keys):
+    # each middle service in its own thread, results by settings key
+    access_token = tuple(session['access_token'])
+    _, oauth_secret = access_token
+    stored = session.get('middle_resources') or {}
+
+    def loader(settings_key):
+        return run_in_app_context(access_token,
+            partial(load_resources, settings_key, oauth_secret, stored.get(settings_key)))
+
+    futures = []
+    for settings_key in settings_keys[1:]:
+        try:
+            futures.append((settings_key, get_workers().submit(loader(settings_key))))
+        except Full:
+            futures.append((settings_key, None))
+
+    # the first one is loaded by the current thread
+    resources = { settings_keys[0]: load_resources(settings_keys[0], oauth_secret, stored.get(settings_keys[0])) }
+    for settings_key, future in futures:
+        if future is None:
+            resources[settings_key] = load_resources(settings_key, oauth_secret, stored.get(settings_key))
+        else:
+            resources[settings_key] = future.result()
+
+    session['middle_resources'] = resources
+
+
+@signals.access_token_ready.connect
+def prefetch_middles(sender, access_token):
+    # PREFETCH_MIDDLES: the middle services are called while the blueprint
+    # fetches the user data; one key goes to session['resources'], like
+    # resources_from_middle, several to session['middle_resources']
+    config = sender.config['PASSAPORTE_WEB']
+    settings_keys = config.get('PREFETCH_MIDDLES')
+    if not settings_keys:
+        return None
+    _, oauth_secret = access_token
+    # emptied by the callback on a new token: what is left belongs to this
+    # one, e.g. back from user_required, so it's revalidated, not refetched
+    if len(settings_keys) == 1:
+        stored = { settings_keys[0]: session.get('resources') }
+    else:
+        stored = session.get('middle_resources') or {}
+
+    def loader(settings_key):
+        return run_in_app_context(tuple(access_token),
+            partial(load_resources, settings_key, oauth_secret, stored.get(settings_key)))
+
+    futures = []
+    for settings_key in settings_keys:
+        try:
+            futures.append((settings_key, get_workers().submit(loader(settings_key))))
+        except Full:
+            # left to the first request
+            pass
+
+    def finish():
+        timeout = config.get('PREFETCH_TIMEOUT', 2)
+        deadline = time() + timeout
+        resources = {}
+        for settings_key, future in futures:
+            try:
+                resources[settings_key] = future.result(max(0, deadline - time()))
+            except Exception as exc:
+                # still running, it joins the first request's load
+                logger = sender.logger.getChild(prefetch_middles.__name__).getChild(settings_key)
+                logger.warning('(%s) %s', type(exc).__name__, exc)
+
+        resources = dict(
+            (settings_key, value) for settings_key, value in resources.items()
+            if isinstance(value, Resources)
+        )
+        if len(settings_keys) == 1:
+            if settings_keys[0] in resources:
+                session['resources'] = resources[settings_keys[0]]
+        elif resources:
+            stored = dict(session.get('middle_resources') or {})
+            stored.update(resources)
+            session['middle_resources'] = stored
+
+    return finish
+
+
+def init_middles(app, *settings_keys):
+    # validates the settings at startup and compiles what doesn't depend
+    # on the user; keys not registered here are compiled on first use
+    middles = get_middles(app)
+    for settings_key in settings_keys:
+        middles[settings_key] = MiddleRequest(settings_key, app.config.get(settings_key))
+
+
+def get_middle_request(settings_key):
+    middles = get_middles(app)
+    try:
+        return middles[settings_key]
+
+    except KeyError:
+        with _middles_lock:
+            if settings_key not in middles:
+                middles[settings_key] = MiddleRequest(settings_key, app.config.get(settings_key))
+            return middles[settings_key]
+
+
+def get_middles(app):
+    return app.extensions.setdefault('identity_client', {}).setdefault('middles', {})
+
+
+def load_resources(settings_key, oauth_secret, current):
     settings = app.config[settings_key]
-    token = ':'.join((settings['TOKEN'], settings['SECRET'])).encode('base64').strip()
-    auth = ' '.join(('Basic', token))
-    url = join_path(settings['HOST'], settings['PATH'])
+    url, headers = get_middle_request(settings_key).request(oauth_secret)
+
+    cache = get_resources_cache(settings_key)
+    tombstones = get_tombstones(settings_key)
+    cached = cache.get(oauth_secret) if cache is not None else None
+    if cached is not None and tombstones is not None and is_invalidated(tombstones, None, cached):
+        cache.delete(oauth_secret)
+        cached = None
+    if cached is not None:
+        # already fetched by another session, or failed not long ago
+        signals.send_outbound_call(settings_key, 0, cache='hit')
+        return cached.value if isinstance(cached, Negative) else cached
 
-    _, oauth_secret = session['access_token']
-    url = '{url}?oauth_token_secret={secret}&oauth_scope={scope}' \
-          .format(
-              url = url,
-              secret = escape(oauth_secret),
-              scope = escape(url),
-          )
-
-    headers = {
-        'Authorization': auth,
-        'Accept': 'application/json',
-    }
-
-    current = session.get('resources')
     if current:
         current = current if isinstance(current, Resources) else Resources(*current)
+        if tombstones is not None and is_invalidated(tombstones, oauth_secret, current):
+            # pushed by the middle service: expired, and not even stale
+            current = current._replace(expires=None)
 
         if current.expires and current.expires > time():
             # not expired yet, grant it’s a resource instance
-            session['resources'] = current
-            return
+            if cache is not None:
+                cache.set(oauth_secret, current, timeout=current.expires - time())
+            signals.send_outbound_call(settings_key, 0, cache='hit')
+            return current
 
         if current.etag:
             headers['If-None-Match'] = current.etag
+        elif current.last_modified:
+            headers['If-Modified-Since'] = current.last_modified
+
+    def fetch():
+        resources = make_request(url, headers, current, endpoint=settings_key, max_age=settings.get('MAX_AGE'))
+        if tombstones is not None and tombstones.get('secret:' + oauth_secret) is not None:
+            # this session has got the news
+            tombstones.delete('secret:' + oauth_secret)
+        if cache is not None:
+            if isinstance(resources, Resources) and resources.expires:
+                cache.set(oauth_secret, resources, timeout=resources.expires - time())
+            elif resources is Unauthorized and settings.get('UNAUTHORIZED_TTL'):
+                # revoked tokens don't need to be checked on every request
+                cache.set(oauth_secret, Negative(Unauthorized), timeout=settings['UNAUTHORIZED_TTL'])
+            else:
+                cache.delete(oauth_secret)
+        return resources
+
+    key = (settings_key, oauth_secret)
+    timeout = settings.get('COALESCE_TIMEOUT', 10)
+
+    if is_stale_usable(current, settings.get('STALE_WHILE_REVALIDATE')):
+        # serve it as is, the cache will get the fresh one
+        if key not in _inflight:
+            revalidate = run_in_app_context(get_access_token(),
+                partial(_inflight.do, key, fetch, timeout=timeout))
+
+            try:
+                get_workers().submit(revalidate)
+            except Full:
+                pass
+        signals.send_outbound_call(settings_key, 0, cache='stale')
+        return current
 
     try:
-        session['resources'] = make_request(url, headers, current)
+        # parallel requests from the same user share a single fetch
+        return _inflight.do(key, fetch, timeout=timeout)
+
+    except CircuitOpenError as exc:
+        # the service is down, the last known resources are better than nothing
+        logger = app.logger.getChild(resources_from_middle.__name__).getChild(settings_key)
+        logger.warning('(%s) %s', type(exc).__name__, exc)
+        return current
 
     except HttpLib2Error as exc:
         logger = app.logger.getChild(resources_from_middle.__name__).getChild(settings_key)
         logger.error('(%s) %s', type(exc).__name__, exc)
-        session['resources'] = None
 
     except HTTPException as exc:
         logger = app.logger.getChild(resources_from_middle.__name__).getChild(settings_key)
         logger.error('(%s) code:%s - %s', type(exc).__name__, exc.code, exc)
-        session['resources'] = None
 
+    resources = current if is_stale_usable(current, settings.get('STALE_IF_ERROR')) else None
+    if cache is not None and settings.get('ERROR_TTL'):
+        # the same outcome until it's time to try again
+        cache.set(oauth_secret, Negative(resources), timeout=settings['ERROR_TTL'])
+    return resources
+
+
+def is_stale_usable(current, window):
+    if current and current.must_revalidate:
+        return False
+    return bool(current and window and current.expires and current.expires + window > time())
+
+
+DEFAULT_CACHE_SIZE = 1024
+MAX_AGE = 600
+NEEDS_CACHE = ('STALE_WHILE_REVALIDATE', 'ERROR_TTL', 'UNAUTHORIZED_TTL')
+
+_inflight = SingleFlight()
+_middles_lock = Lock()
+_resources_caches_lock = Lock()
+_workers_lock = Lock()
+
+
+def get_resources_cache(settings_key):
+    # per application, shared by all sessions; enabled by the CACHE_SIZE setting
+    caches = app.extensions.setdefault('identity_client', {}).setdefault('resources', {})
+    try:
+        return caches[settings_key]
+
+    except KeyError:
+        settings = app.config[settings_key]
+        maxsize = settings.get('CACHE_SIZE')
+        if not maxsize and any(settings.get(name) for name in NEEDS_CACHE):
+            # background revalidations and failures are remembered by the cache
+            maxsize = DEFAULT_CACHE_SIZE
+        if not maxsize:
+            return None
 
-def make_request(url, headers, current):
-    response = PWRemoteApp.get_instance().get(url, headers=headers)
+        with _resources_caches_lock:
+            return caches.setdefault(settings_key, make_cache('resources:' + settings_key, maxsize))
 
-    expires = parsedate_tz(response.headers.get('Expires'))
-    expires = min(mktime_tz(expires), time() + 600) if expires else None
+
+def get_tombstones(settings_key):
+    # secrets and ETags invalidated by the middle service, for the copies
+    # kept in the sessions; enabled by the PUSH_INVALIDATION setting
+    tombstones = app.extensions.setdefault('identity_client', {}).setdefault('tombstones', {})
+    try:
+        return tombstones[settings_key]
+
+    except KeyError:
+        settings = app.config[settings_key]
+        if not settings.get('PUSH_INVALIDATION'):
+            return None
+
+        with _resources_caches_lock:
+            # looked up on every request, found only once in a while
+            return tombstones.setdefault(settings_key, make_cache(
+                'tombstones:' + settings_key, settings.get('TOMBSTONES_SIZE', DEFAULT_CACHE_SIZE),
+                cache_misses = True,
+            ))
+
+
+def is_invalidated(tombstones, oauth_secret, resources):
+    if oauth_secret and tombstones.get('secret:' + oauth_secret) is not None:
+        return True
+    etag = getattr(resources, 'etag', None)
+    return bool(etag) and tombstones.get('etag:' + etag) is not None
+
+
+def run_in_app_context(access_token, f):
+    # for the workers: the application and the user's token, not the
+    # request, so neither the session is reopened nor teardown_request
+    # handlers run once per task
+    flask_app = app._get_current_object()
+
+    def task():
+        with flask_app.app_context():
+            g.access_token = access_token
+            return f()
+    return task
+
+
+def get_workers():
+    # background revalidations and parallel loading, shared by all middle services
+    extension = app.extensions.setdefault('identity_client', {})
+    workers = extension.get('middle_workers')
+    if workers is None:
+        with _workers_lock:
+            workers = extension.get('middle_workers')
+            if workers is None:
+                workers = extension['middle_workers'] = WorkerPool(
+                    max_workers = app.config.get('MIDDLE_WORKERS', 4),
+                    name = 'resources_from_middle',
+                    logger = app.logger.getChild(resources_from_middle.__name__),
+                )
+    return workers
+
+
+def make_request(url, headers, current, endpoint='middle', max_age=None):
+    with signals.OutboundCall(endpoint) as call:
+        response = PWRemoteApp.get_instance().get(url, headers=headers)
+        call.result(response.status, response.raw_data)
+    return parse_resources(response, current, max_age)
+
+
+def parse_resources(response, current, max_age=None):
+    expires, must_revalidate, store = freshness(response.headers, max_age)
 
     if response.status == 200:
         return Resources(
             data = response.data,
-            etag = response.headers.get('ETag'),
+            # no-store: nothing to revalidate with later
+            etag = response.headers.get('ETag') if store else None,
             expires = expires,
+            last_modified = response.headers.get('Last-Modified') if store else None,
+            must_revalidate = must_revalidate,
         )
 
     elif response.status == 401:
@@ -113,8 +499,10 @@ def make_request(url, headers, current):
         # no changes
         return Resources(
             data = current.data,
-            etag = current.etag,
+            etag = response.headers.get('ETag') or current.etag,
             expires = expires,
+            last_modified = response.headers.get('Last-Modified') or current.last_modified,
+            must_revalidate = must_revalidate,
         )
 
     else:
@@ -124,9 +512,97 @@ def make_request(url, headers, current):
         raise exc_class(response.data)
 
 
+def freshness(headers, max_age=None):
+    # RFC 7234: (expires timestamp or None, must-revalidate, may be stored),
+    # the lifetime capped at max_age seconds
+    max_age = MAX_AGE if max_age is None else max_age
+    directives = parse_cache_control(headers.get('Cache-Control'))
+    must_revalidate = 'must-revalidate' in directives
+    if 'no-store' in directives:
+        return None, True, False
+    if 'no-cache' in directives:
+        return None, must_revalidate, True
+
+    now = time()
+    date = parse_date(headers.get('Date'))
+    try:
+        lifetime = int(directives['max-age'])
+    except (KeyError, TypeError, ValueError):
+        lifetime = None
+
+    if lifetime is None:
+        expires = parse_date(headers.get('Expires'))
+        if expires is None:
+            return None, must_revalidate, True
+        lifetime = expires - (now if date is None else date)
+
+    try:
+        age = max(0, int(headers.get('Age') or 0))
+    except ValueError:
+        age = 0
+    if date is not None:
+        age = max(age, now - date)
+
+    return now + min(lifetime, max_age) - age, must_revalidate, True
+
+
+def parse_cache_control(value):
+    directives = {}
+    for directive in (value or '').split(','):
+        name, _, argument = directive.partition('=')
+        if name.strip():
+            directives[name.strip().lower()] = argument.strip().strip('"') or None
+    return directives
+
+
+def parse_date(value):
+    value = parsedate_tz(value) if value else None
+    return mktime_tz(value) if value else None
+
+
 #-----------------------------------------------------------------------
 # Auxiliar
 
+def middle_request(settings, oauth_secret):
+    return MiddleRequest('middle', settings).request(oauth_secret)
+
+
+class MiddleRequest(object):
+
+    # authorization header and URL prefix are the same for every user,
+    # only the token secret changes
+
+    required = ('TOKEN', 'SECRET', 'HOST', 'PATH')
+
+    def __init__(self, settings_key, settings):
+        if not isinstance(settings, dict):
+            raise ValueError('{0}: middle settings not found'.format(settings_key))
+
+        missing = [name for name in self.required if not settings.get(name)]
+        if missing:
+            raise ValueError('{0}: missing {1}'.format(settings_key, ', '.join(missing)))
+
+        if not settings['HOST'].startswith(('http://', 'https://')):
+            raise ValueError('{0}: HOST must start with http:// or https://'.format(settings_key))
+
+        token = ':'.join((settings['TOKEN'], settings['SECRET'])).encode('base64').replace('\n', '')
+        url = join_path(settings['HOST'], settings['PATH'])
+
+        self.url = url
+        self.query = '{url}?oauth_token_secret={{0}}&oauth_scope={scope}'.format(
+            url = url.replace('{', '{{').replace('}', '}}'),
+            scope = escape(url).replace('{', '{{').replace('}', '}}'),
+        )
+        self.headers = {
+            'Authorization': ' '.join(('Basic', token)),
+            'Accept': 'application/json',
+        }
+
+    def request(self, oauth_secret):
+        # headers are copied, callers add If-None-Match
+        return self.query.format(escape(oauth_secret)), dict(self.headers)
+
+
 def join_path(host, path):
     host = host[:-1] if host.endswith('/') else host
     path = path[1:] if path.startswith('/') else path
@@ -135,4 +611,8 @@ def join_path(host, path):
 
 escape = lambda s: urllib.quote(s.encode('utf-8'), safe='~ ').replace(' ', '+')
 
-Resources = namedtuple('Resources', 'data etag expires')
+Resources = namedtuple('Resources', 'data etag expires last_modified must_revalidate')
+Resources.__new__.__defaults__ = (None, False)
+
+# cached failure: None or Unauthorized
+Negative = namedtuple('Negative', 'value')
@@ -0,0 +1,92 @@
+# coding: UTF-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from bisect import bisect_left
+from threading import Lock
+from .signals import outbound_call
+
+__all__ = ['OutboundStats', 'enable_stats']
+
+
+# upper bounds in seconds, the last bucket takes the rest
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class OutboundStats(object):
+
+    # per-endpoint latency histograms, fed by signals.outbound_call
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self._endpoints = {}
+        self._lock = Lock()
+
+    def __call__(self, sender, endpoint, duration, status=None, size=None, cache=None, error=None):
+        with self._lock:
+            stats = self._endpoints.get(endpoint)
+            if stats is None:
+                stats = self._endpoints[endpoint] = {
+                    'count': 0,
+                    'errors': 0,
+                    'bytes': 0,
+                    'total': 0.,
+                    'status': {},
+                    'cache': {},
+                    'histogram': [0] * (len(self.buckets) + 1),
+                }
+
+            stats['count'] += 1
+            stats['total'] += duration
+            stats['bytes'] += size or 0
+            stats['histogram'][bisect_left(self.buckets, duration)] += 1
+            if error:
+                stats['errors'] += 1
+            if status is not None:
+                stats['status'][status] = stats['status'].get(status, 0) + 1
+            if cache:
+                stats['cache'][cache] = stats['cache'].get(cache, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(
+                (endpoint, self._summary(stats))
+                for endpoint, stats in self._endpoints.items()
+            )
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+
+    def _summary(self, stats):
+        bounds = self.buckets + (None,)
+        return {
+            'count': stats['count'],
+            'errors': stats['errors'],
+            'bytes': stats['bytes'],
+            'mean': stats['total'] / stats['count'],
+            'status': dict(stats['status']),
+            'cache': dict(stats['cache']),
+            'histogram': zip(bounds, stats['histogram']),
+            'p50': self._percentile(stats, .5),
+            'p90': self._percentile(stats, .9),
+            'p99': self._percentile(stats, .99),
+        }
+
+    def _percentile(self, stats, fraction):
+        # upper bound of the bucket holding the percentile,
+        # None if it is beyond the last bound
+        rank = fraction * stats['count']
+        seen = 0
+        for bound, count in zip(self.buckets, stats['histogram']):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+
+def enable_stats(app, buckets=BUCKETS):
+    # stats = enable_stats(app); stats.snapshot()
+    stats = OutboundStats(buckets)
+    outbound_call.connect(stats, sender=app, weak=False)
+    app.extensions.setdefault('identity_client', {})['stats'] = stats
+    return stats
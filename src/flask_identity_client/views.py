@@ -1,12 +1,19 @@
 # coding: UTF-8
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-from flask import abort, current_app as app, escape, redirect, request, url_for, session
+from copy import deepcopy
+from threading import Lock
+from weakref import WeakKeyDictionary
+import oauth2
+from flask import abort, current_app as app, escape, g, has_request_context, redirect, request, url_for, session
 try:
-    from flask_oauth import OAuthRemoteApp, OAuthException, parse_response
+    from flask_oauth import OAuthRemoteApp, OAuthClient, OAuthException, parse_response
 except ImportError:
-    from flaskext.oauth import OAuthRemoteApp, OAuthException, parse_response
+    from flaskext.oauth import OAuthRemoteApp, OAuthClient, OAuthException, parse_response
 from .application import blueprint
+from .breaker import CircuitBreakers
+from .pool import ConnectionPool, PooledHttpMixin
+from .shared import make_cache
 from . import signals
 
 __all__ = []
@@ -22,9 +29,35 @@ def index():
     if access_token is None:
         return redirect(url_for('identity_client.login'))
 
+    next_url = escape(request.values.get('next') \
+                   or url_for(app.config.get('ENTRYPOINT', 'index')))
+
+    # receivers may start work in the background (e.g. PREFETCH_MIDDLES)
+    # and return a function that waits for it and updates the session
+    pending = [
+        finish for _, finish in signals.access_token_ready.send(
+            app._get_current_object(),
+            access_token = tuple(access_token),
+        ) if finish is not None
+    ]
+
+    user_data_cache = get_user_data_cache()
+    if user_data_cache is not None:
+        user_data = user_data_cache.get(access_token[0])
+        if user_data is not None:
+            # already fetched with this token
+            signals.send_outbound_call('fetch_user_data', 0, cache='hit')
+            session['user_data'] = deepcopy(user_data)
+            for finish in pending:
+                finish()
+            return redirect(next_url)
+
     config = app.config['PASSAPORTE_WEB']
     fetch_user_data_url = '/'.join((config['HOST'], config['FETCH_USER_DATA_PATH']))
-    original_user_data = PWRemoteApp.get_instance().post(fetch_user_data_url).data
+    with signals.OutboundCall('fetch_user_data') as call:
+        response = PWRemoteApp.get_instance().post(fetch_user_data_url)
+        call.result(response.status, response.raw_data)
+    original_user_data = response.data
 
     #-------------------------------------------------------------------
     # Extração de dados
@@ -46,19 +79,25 @@ def index():
     else:
         user_data['full_name'] = user_data['email']
 
-    signals.update_service_account.send(
+    signals.send_update_service_account(
         app._get_current_object(),
         user_data=original_user_data,
     )
 
-    user_data['accounts'] = [uuid for uuid in (
-        account.get('uuid')
-        for account in original_user_data.get('accounts', [])
-    ) if uuid]
+    if not config.get('LAZY_ACCOUNTS'):
+        user_data['accounts'] = [uuid for uuid in (
+            account.get('uuid')
+            for account in original_user_data.get('accounts', [])
+        ) if uuid]
+    # with LAZY_ACCOUNTS, only the identity goes to the session,
+    # accounts are loaded on demand by flask_identity_client.accounts
     session['user_data'] = user_data
 
-    next_url = escape(request.values.get('next') \
-                   or url_for(app.config.get('ENTRYPOINT', 'index')))
+    if user_data_cache is not None:
+        user_data_cache.set(access_token[0], deepcopy(user_data), timeout=config['USER_DATA_TTL'])
+
+    for finish in pending:
+        finish()
     return redirect(next_url)
 
 
@@ -77,7 +116,13 @@ def login():
 @blueprint.route('/logout', methods=['GET'])
 def logout():
     session.pop('user_data', None)
-    session.pop('access_token', None)
+    access_token = session.pop('access_token', None)
+
+    user_data_cache = get_user_data_cache()
+    if access_token and user_data_cache is not None:
+        user_data_cache.delete(access_token[0])
+    if access_token:
+        signals.token_revoked.send(app._get_current_object(), access_token=tuple(access_token))
 
     # TODO: trocar pela página comercial
     next_url = escape(request.values.get('next', '')) \
@@ -94,6 +139,13 @@ def authorized():
     def authorized_handler(resp):
         access_token = resp['oauth_token']
         token_secret = resp['oauth_token_secret']
+        if hasattr(session, 'regenerate'):
+            # server side sessions: a new id for the logged in user
+            session.regenerate()
+        if tuple(session.get('access_token') or ()) != (access_token, token_secret):
+            # the middle resources belong to the previous token
+            session.pop('resources', None)
+            session.pop('middle_resources', None)
         session['access_token'] = (access_token, token_secret)
 
         if next_url:
@@ -106,20 +158,83 @@ def authorized():
     return authorized_handler()
 
 
+def get_access_token():
+    # the one given to a background task (g.access_token), which runs
+    # without the request, or the session's
+    access_token = getattr(g, 'access_token', None)
+    if access_token is None and has_request_context():
+        access_token = session.get('access_token')
+    return access_token
+
+
+_extension_lock = Lock()
+
+
+def get_user_data_cache():
+    # processed user data by access token, enabled by USER_DATA_TTL;
+    # USER_DATA_STORE may be any cache (e.g. shared by all processes)
+    config = app.config['PASSAPORTE_WEB']
+    if not config.get('USER_DATA_TTL'):
+        return None
+
+    store = config.get('USER_DATA_STORE')
+    if store is not None:
+        return store
+
+    extension = app.extensions.setdefault('identity_client', {})
+    store = extension.get('user_data')
+    if store is None:
+        with _extension_lock:
+            store = extension.setdefault('user_data', make_cache('user_data', config.get('USER_DATA_CACHE_SIZE', 1024)))
+    return store
+
+
+class PooledClient(PooledHttpMixin, oauth2.Client):
+
+    def request(self, *args, **kwargs):
+        resp, content = super(PooledClient, self).request(*args, **kwargs)
+        # OAuthResponse parses by content type, missing in 304 responses
+        resp.setdefault('content-type', '')
+        return resp, content
+
+
+class PooledOAuthClient(PooledHttpMixin, OAuthClient):
+
+    def request_new_token(self, uri, *args, **kwargs):
+        # OAuthClient.request_new_token bypasses self.request
+        with signals.OutboundCall('request_token') as call:
+            resp, content = self.guarded(uri, OAuthClient.request_new_token, self, uri, *args, **kwargs)
+            call.result(resp.status, content)
+        return resp, content
+
+
 class PWRemoteApp(OAuthRemoteApp):
 
-    # TODO: colocar isso no módulo da aplicação
-    __passaporte_web = None
+    # one instance per Flask application, built when the blueprint is registered
+    _instances = WeakKeyDictionary()
+    _instances_lock = Lock()
+
+    def __init__(self, *args, **kwargs):
+        # all requests share the same keep-alive connections
+        self.pool = kwargs.pop('pool', None) or ConnectionPool()
+        self.breakers = kwargs.pop('breakers', None)
+        super(PWRemoteApp, self).__init__(*args, **kwargs)
+        self._client = PooledOAuthClient(self._consumer, pool=self.pool, breakers=self.breakers)
+
+    def make_client(self):
+        return PooledClient(self._consumer, self.get_request_token(), pool=self.pool, breakers=self.breakers)
 
     def handle_oauth1_response(self):
         client = self.make_client()
 
         data = 'oauth_verifier={0}'.format(request.values['oauth_verifier'])
-        resp, content = client.request(
-            self.expand_url(self.access_token_url),
-            self.access_token_method,
-            body = data,
-        )
+        with signals.OutboundCall('access_token') as call:
+            resp, content = client.request(
+                self.expand_url(self.access_token_url),
+                self.access_token_method,
+                body = data,
+            )
+            call.result(resp.status, content)
 
         data = parse_response(resp, content)
         if resp['status'] != '200':
@@ -127,39 +242,67 @@ class PWRemoteApp(OAuthRemoteApp):
         return data
 
     @classmethod
-    def get_instance(cls):
-        if cls.__passaporte_web is None:
-            config = app.config['PASSAPORTE_WEB']
-            passaporte_web = cls(None, 'passaporte web',
-                # unless absolute urls are used to make requests, this will be added
-                # before all URLs.  This is also true for request_token_url and others.
-                base_url = config['HOST'],
-
-                # where flask should look for new request tokens
-                request_token_url = config['REQUEST_TOKEN_PATH'],
-                request_token_params = {
-                    'scope': escape(config.get('SCOPE', 'auth:api')),
-                },
-
-                # where flask should exchange the token with the remote application
-                access_token_url = config['ACCESS_TOKEN_PATH'],
-                access_token_method = 'POST',
-
-                # twitter knows two authorizatiom URLs.  /authorize and /authenticate.
-                # they mostly work the same, but for sign on /authenticate is
-                # expected because this will give the user a slightly different
-                # user interface on the twitter side.
-                authorize_url = config['AUTHORIZATION_PATH'],
-
-                # the consumer keys from the passaporteweb application registry.
-                consumer_key = config['CONSUMER_TOKEN'],
-                consumer_secret = config['CONSUMER_SECRET'],
-            )
+    def get_instance(cls, flask_app=None):
+        flask_app = flask_app or app._get_current_object()
+        try:
+            return cls._instances[flask_app]
+
+        except KeyError:
+            with cls._instances_lock:
+                if flask_app not in cls._instances:
+                    cls._instances[flask_app] = cls.from_config(flask_app.config['PASSAPORTE_WEB'])
+                return cls._instances[flask_app]
+
+    @classmethod
+    def from_config(cls, config):
+        passaporte_web = cls(None, 'passaporte web',
+            # unless absolute urls are used to make requests, this will be added
+            # before all URLs.  This is also true for request_token_url and others.
+            base_url = config['HOST'],
+
+            # where flask should look for new request tokens
+            request_token_url = config['REQUEST_TOKEN_PATH'],
+            request_token_params = {
+                'scope': escape(config.get('SCOPE', 'auth:api')),
+            },
+
+            # where flask should exchange the token with the remote application
+            access_token_url = config['ACCESS_TOKEN_PATH'],
+            access_token_method = 'POST',
+
+            # twitter knows two authorizatiom URLs.  /authorize and /authenticate.
+            # they mostly work the same, but for sign on /authenticate is
+            # expected because this will give the user a slightly different
+            # user interface on the twitter side.
+            authorize_url = config['AUTHORIZATION_PATH'],
+
+            # the consumer keys from the passaporteweb application registry.
+            consumer_key = config['CONSUMER_TOKEN'],
+            consumer_secret = config['CONSUMER_SECRET'],
+
+            # keep-alive connections, reused by PassaporteWeb and middle requests
+            pool = ConnectionPool(
+                maxsize = config.get('POOL_SIZE', 4),
+                idle_timeout = config.get('POOL_IDLE_TIMEOUT', 30),
+            ),
+
+            # fail fast while PassaporteWeb or a middle service is down
+            breakers = CircuitBreakers(
+                threshold = config['BREAKER_THRESHOLD'],
+                reset_timeout = config.get('BREAKER_RESET_TIMEOUT', 30),
+                probes = config.get('BREAKER_PROBES', 1),
+                on_change = signals.send_circuit_state,
+            ) if config.get('BREAKER_THRESHOLD') else None,
+        )
+
+        passaporte_web.tokengetter(get_access_token)
 
-            @passaporte_web.tokengetter
-            def tokengetter():
-                return session.get('access_token')
+        return passaporte_web
 
-            cls.__passaporte_web = passaporte_web
 
-        return cls.__passaporte_web
+@blueprint.record_once
+def create_remote_app(state):
+    # eager, so the first request doesn't pay for it; applications
+    # configured after registering the blueprint get it on first use
+    if 'PASSAPORTE_WEB' in state.app.config:
+        PWRemoteApp.get_instance(state.app)
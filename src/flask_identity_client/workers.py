@@ -0,0 +1,93 @@
+# coding: UTF-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import logging
+from Queue import Queue, Full
+from threading import Condition, Event, Lock, Thread
+from time import time
+
+__all__ = ['Future', 'WorkerPool', 'Full']
+
+
+class Future(object):
+
+    def __init__(self):
+        self._done = Event()
+        self._value = None
+        self._error = None
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise RuntimeError('result not available after {0}s'.format(timeout))
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def set_result(self, value):
+        self._value = value
+        self._done.set()
+
+    def set_exception(self, error):
+        self._error = error
+        self._done.set()
+
+
+class WorkerPool(object):
+
+    # bounded pool of daemon threads fed by a bounded queue;
+    # submit raises Full instead of blocking when the queue is full
+
+    def __init__(self, max_workers=4, max_queue=256, name='workers', logger=None):
+        self.max_workers = max_workers
+        self.name = name
+        self.logger = logger or logging.getLogger(__name__).getChild(name)
+        self._queue = Queue(max_queue)
+        self._threads = []
+        self._lock = Lock()
+        self._unfinished = 0
+        self._all_done = Condition(self._lock)
+
+    def submit(self, f, *args, **kwargs):
+        future = Future()
+        with self._lock:
+            self._queue.put_nowait((f, args, kwargs, future))
+            self._unfinished += 1
+            if len(self._threads) < self.max_workers:
+                self._start_worker()
+        return future
+
+    def join(self, timeout=None):
+        # waits until every submitted task is done; False if timed out
+        deadline = None if timeout is None else time() + timeout
+        with self._all_done:
+            while self._unfinished:
+                remaining = None if deadline is None else deadline - time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._all_done.wait(remaining)
+        return True
+
+    def _start_worker(self):
+        thread = Thread(target=self._work, name='{0}-{1}'.format(self.name, len(self._threads)))
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            f, args, kwargs, future = self._queue.get()
+            try:
+                future.set_result(f(*args, **kwargs))
+
+            except Exception as exc:
+                self.logger.exception('(%s) %s', type(exc).__name__, exc)
+                future.set_exception(exc)
+
+            finally:
+                with self._all_done:
+                    self._unfinished -= 1
+                    if not self._unfinished:
+                        self._all_done.notify_all()
@@ -1,2 +1,14 @@
+from .test_accounts import *
+from .test_aio import *
+from .test_bench import *
+from .test_breaker import *
+from .test_cache import *
+from .test_pool import *
+from .test_sessions import *
+from .test_shared import *
+from .test_signals import *
+from .test_singleflight import *
 from .test_startup_funcs import *
+from .test_stats import *
 from .test_views import *
+from .test_workers import *
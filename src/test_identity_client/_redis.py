@@ -0,0 +1,113 @@
+# coding: UTF-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from fnmatch import fnmatchcase
+from SocketServer import StreamRequestHandler, ThreadingTCPServer
+from threading import Thread, Lock
+from time import time
+
+from flask_identity_client.resp import encode_command, read_reply
+
+__all__ = ['RedisStub']
+
+
+class RedisStub(ThreadingTCPServer):
+
+    # local stand-in for a Redis server, just enough for the tests
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), RedisStubHandler)
+        self.data = {}
+        self.lock = Lock()
+        self.commands = []
+        self.subscribers = {}
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        thread = Thread(target=self.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class RedisStubHandler(StreamRequestHandler):
+
+    def handle(self):
+        while True:
+            try:
+                args = read_reply(self.rfile)
+            except Exception:
+                with self.server.lock:
+                    for subscribers in self.server.subscribers.values():
+                        if self.wfile in subscribers:
+                            subscribers.remove(self.wfile)
+                return
+
+            command = args[0].upper()
+            self.server.commands.append(command)
+            handler = getattr(self, 'do_' + command.decode('ascii'), None)
+            if handler is None:
+                self.wfile.write(b'-ERR unknown command\r\n')
+            else:
+                with self.server.lock:
+                    handler(*args[1:])
+            self.wfile.flush()
+
+    def do_PING(self):
+        self.wfile.write(b'+PONG\r\n')
+
+    def do_GET(self, key):
+        expires, value = self.server.data.get(key, (None, None))
+        if expires is not None and expires <= time():
+            del self.server.data[key]
+            value = None
+
+        if value is None:
+            self.wfile.write(b'$-1\r\n')
+        else:
+            self.wfile.write(b'$' + str(len(value)).encode('ascii') + b'\r\n' + value + b'\r\n')
+
+    def do_SET(self, key, value):
+        self.server.data[key] = (None, value)
+        self.wfile.write(b'+OK\r\n')
+
+    def do_SETEX(self, key, timeout, value):
+        self.server.data[key] = (time() + int(timeout), value)
+        self.wfile.write(b'+OK\r\n')
+
+    def do_DEL(self, *keys):
+        count = sum(1 for key in keys if self.server.data.pop(key, None) is not None)
+        self.wfile.write(b':' + str(count).encode('ascii') + b'\r\n')
+
+    def do_SUBSCRIBE(self, *channels):
+        for count, channel in enumerate(channels, 1):
+            self.server.subscribers.setdefault(channel, []).append(self.wfile)
+            self.wfile.write(encode_command((b'subscribe', channel, count)))
+
+    def do_PUBLISH(self, channel, message):
+        subscribers = self.server.subscribers.get(channel, [])
+        for wfile in subscribers:
+            wfile.write(encode_command((b'message', channel, message)))
+            wfile.flush()
+        self.wfile.write(b':' + str(len(subscribers)).encode('ascii') + b'\r\n')
+
+    def do_SCAN(self, cursor, *args):
+        # everything at once, with the final cursor
+        options = dict(zip(args[::2], args[1::2]))
+        pattern = options.get(b'MATCH', b'*')
+        keys = [key for key in self.server.data if fnmatchcase(key, pattern)]
+        self.wfile.write(b'*2\r\n$1\r\n0\r\n' + encode_command(keys))
+
+    def do_FLUSHDB(self):
+        self.server.data.clear()
+        self.wfile.write(b'+OK\r\n')
@@ -0,0 +1,134 @@
+# coding: UTF-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from flask import url_for
+from mock import Mock, patch
+from werkzeug.exceptions import Unauthorized
+from model_resource import ServiceAccount
+from ._base import TestCase
+
+from flask_identity_client import accounts
+
+
+__all__ = ['TestAccounts', 'TestLazyAccounts']
+
+
+def account(i):
+    return { 'uuid': 'd9a795c8-c891-4665-ac63-{0:012d}'.format(i), 'name': 'Account {0}'.format(i) }
+
+
+class TestAccounts(TestCase):
+
+    uuid = 'a82670c2-027e-4079-b5c7-81f2433041b3'
+
+    def setUp(self):
+        self.config = patch.dict(self.app.config['PASSAPORTE_WEB'], { 'ACCOUNTS_PAGE_SIZE': 2 })
+        self.config.start()
+        self.session = patch('flask_identity_client.accounts.session', { 'user_data': { 'uuid': self.uuid } })
+        self.session.start()
+
+    def tearDown(self):
+        self.session.stop()
+        self.config.stop()
+        self.app.extensions['identity_client'].pop('accounts', None)
+
+    def response(self, data, status=200):
+        response = Mock()
+        response.status = status
+        response.data = data
+        response.raw_data = b''
+        return response
+
+    @patch('flask_identity_client.accounts.PWRemoteApp')
+    def test_paginated(self, mock_remote_app):
+        get = mock_remote_app.get_instance.return_value.get
+        get.side_effect = [
+            self.response({ 'items': [account(1), account(2)], 'next': 'page=2' }),
+            self.response({ 'items': [account(3)], 'next': None }),
+        ]
+
+        self.assertEqual(list(accounts.account_uuids()), [account(i)['uuid'] for i in (1, 2, 3)])
+
+        config = self.app.config['PASSAPORTE_WEB']
+        url = '/'.join((config['HOST'], config['FETCH_ACCOUNTS'].format(uuid=self.uuid)))
+        self.assertEqual([call[0][0] for call in get.call_args_list], [
+            url + '?page=1&page_size=2',
+            url + '?page=2&page_size=2',
+        ])
+
+    @patch('flask_identity_client.accounts.PWRemoteApp')
+    def test_lazy(self, mock_remote_app):
+        get = mock_remote_app.get_instance.return_value.get
+        get.return_value = self.response({ 'items': [account(1), account(2)], 'next': 'page=2' })
+
+        first = next(accounts.iter_accounts())
+        self.assertEqual(first, account(1))
+        self.assertEqual(get.call_count, 1)
+
+    @patch('flask_identity_client.accounts.PWRemoteApp')
+    def test_list_response(self, mock_remote_app):
+        get = mock_remote_app.get_instance.return_value.get
+        # a full page, ignoring page_size: no more requests
+        get.return_value = self.response([account(1), account(2)])
+
+        self.assertEqual(accounts.get_accounts(), [account(1), account(2)])
+        self.assertEqual(get.call_count, 1)
+
+    @patch('flask_identity_client.accounts.PWRemoteApp')
+    def test_cached(self, mock_remote_app):
+        get = mock_remote_app.get_instance.return_value.get
+        get.return_value = self.response({ 'items': [account(1)] })
+
+        accounts.get_accounts()
+        accounts.get_accounts()
+        self.assertEqual(get.call_count, 1)
+
+        accounts.invalidate(self.uuid)
+        accounts.get_accounts()
+        self.assertEqual(get.call_count, 2)
+
+    @patch('flask_identity_client.cache.time')
+    @patch('flask_identity_client.accounts.time')
+    @patch('flask_identity_client.accounts.PWRemoteApp')
+    def test_ttl(self, mock_remote_app, mock_time, mock_cache_time):
+        get = mock_remote_app.get_instance.return_value.get
+        get.return_value = self.response({ 'items': [account(1)] })
+        mock_time.return_value = mock_cache_time.return_value = 1000
+
+        accounts.get_accounts()
+        mock_time.return_value = mock_cache_time.return_value = 1300
+        accounts.get_accounts()
+
+        self.assertEqual(get.call_count, 2)
+
+    @patch('flask_identity_client.accounts.PWRemoteApp')
+    def test_error(self, mock_remote_app):
+        mock_remote_app.get_instance.return_value.get.return_value = self.response(None, status=401)
+
+        self.assertRaises(Unauthorized, accounts.get_accounts)
+        self.assertTrue(self.app.extensions['identity_client']['accounts'].get(self.uuid) is None)
+
+
+class TestLazyAccounts(TestCase):
+
+    @patch.object(ServiceAccount, 'update')
+    @patch('flask_identity_client.views.PWRemoteApp')
+    @patch('flask_identity_client.views.session')
+    def test_session_holds_only_the_identity(self, session, remote_app, update_service_account):
+        session.get.return_value = ('R0JaNT1RKNDP', 'W3oZSRHACS090Xwf')
+        data = remote_app.get_instance.return_value.post.return_value.data = {
+            'uuid': 'a82670c2-027e-4079-b5c7-81f2433041b3',
+            'email': 'johndoe@myfreecomm.com.br',
+            'accounts': [account(i) for i in range(100)],
+        }
+
+        with patch.dict(self.app.config['PASSAPORTE_WEB'], { 'LAZY_ACCOUNTS': True }):
+            response = self.client.get(url_for('identity_client.index'))
+
+        self.assertStatus(response, 302)
+        update_service_account.assert_called_once_with(data)
+        session.__setitem__.assert_called_once_with('user_data', {
+            'uuid': 'a82670c2-027e-4079-b5c7-81f2433041b3',
+            'email': 'johndoe@myfreecomm.com.br',
+            'full_name': 'johndoe@myfreecomm.com.br',
+        })
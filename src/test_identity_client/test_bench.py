@@ -0,0 +1,26 @@
+# coding: UTF-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from unittest import TestCase
+
+import bench
+
+
+__all__ = ['TestBench']
+
+
+class TestBench(TestCase):
+
+    def test_run(self):
+        # every scenario goes through the stub servers without errors
+        results = bench.run(iterations=2)
+
+        self.assertEqual([name for name, _ in results], ['cold', 'warm', 'revalidate', 'expired'])
+        for name, result in results:
+            self.assertEqual(result['iterations'], 2)
+            self.assertTrue(result['throughput'] > 0)
+            self.assertTrue(result['p50'] <= result['p99'] <= result['max'])
+
+    def test_selected_scenarios(self):
+        results = bench.run(iterations=1, scenarios=['warm'])
+        self.assertEqual([name for name, _ in results], ['warm'])
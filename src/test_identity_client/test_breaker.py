@@ -0,0 +1,214 @@
+# coding: UTF-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import socket
+from unittest import TestCase as UnitTestCase
+from httplib2 import HttpLib2Error
+from mock import Mock, patch
+from ._base import TestCase
+
+from flask_identity_client.breaker import CircuitBreaker, CircuitBreakers, CircuitOpenError
+from flask_identity_client.signals import circuit_state, send_circuit_state
+from flask_identity_client.startup_funcs import resources_from_middle, Resources
+from flask_identity_client.views import PWRemoteApp
+
+
+__all__ = ['TestCircuitBreaker', 'TestCircuitBreakers', 'TestOpenCircuit']
+
+
+class TestCircuitBreaker(UnitTestCase):
+
+    @patch('flask_identity_client.breaker.time')
+    def test_states(self, mock_time):
+        changes = []
+        breaker = CircuitBreaker('http://middle.localhost', threshold=2, reset_timeout=30,
+                                 on_change=lambda breaker, previous: changes.append((previous, breaker.state)))
+        mock_time.return_value = 1000
+
+        breaker.before_call()
+        breaker.failure()
+        self.assertEqual(breaker.state, 'closed')
+        breaker.before_call()
+        breaker.failure()
+        self.assertEqual(breaker.state, 'open')
+        self.assertRaises(CircuitOpenError, breaker.before_call)
+
+        # half-open: a single probe goes through
+        mock_time.return_value = 1030
+        probe = breaker.before_call()
+        self.assertEqual(breaker.state, 'half-open')
+        self.assertRaises(CircuitOpenError, breaker.before_call)
+
+        # failed probe opens it again
+        breaker.failure(probe)
+        self.assertEqual(breaker.state, 'open')
+        self.assertRaises(CircuitOpenError, breaker.before_call)
+
+        mock_time.return_value = 1060
+        breaker.success(breaker.before_call())
+        self.assertEqual(breaker.state, 'closed')
+        self.assertEqual(breaker.failures, 0)
+
+        self.assertEqual(changes, [
+            ('closed', 'open'),
+            ('open', 'half-open'),
+            ('half-open', 'open'),
+            ('open', 'half-open'),
+            ('half-open', 'closed'),
+        ])
+
+    @patch('flask_identity_client.breaker.time')
+    def test_probe_slots(self, mock_time):
+        breaker = CircuitBreaker('http://middle.localhost', threshold=1, reset_timeout=30)
+        mock_time.return_value = 1000
+        stale = breaker.before_call()
+        self.assertTrue(stale is None)
+        breaker.failure(breaker.before_call())
+
+        mock_time.return_value = 1030
+        probe = breaker.before_call()
+        self.assertFalse(probe is None)
+
+        # a call started before opening is not a probe
+        breaker.success(stale)
+        self.assertEqual(breaker.state, 'half-open')
+        self.assertRaises(CircuitOpenError, breaker.before_call)
+
+        breaker.failure(probe)
+        self.assertEqual(breaker.state, 'open')
+        # nor is the probe of a previous half-open period
+        mock_time.return_value = 1060
+        second = breaker.before_call()
+        breaker.success(probe)
+        self.assertEqual(breaker.state, 'half-open')
+        self.assertRaises(CircuitOpenError, breaker.before_call)
+
+        breaker.success(second)
+        self.assertEqual(breaker.state, 'closed')
+        self.assertTrue(breaker.before_call() is None)
+
+    @patch('flask_identity_client.breaker.time')
+    def test_probing_reset(self, mock_time):
+        breaker = CircuitBreaker('http://middle.localhost', threshold=1, reset_timeout=30, probes=2)
+        mock_time.return_value = 1000
+        breaker.failure()
+
+        mock_time.return_value = 1030
+        first = breaker.before_call()
+        breaker.before_call()
+        # closed by the first probe, with the second still in flight
+        breaker.success(first)
+        breaker.failure()
+
+        mock_time.return_value = 1060
+        breaker.before_call()
+        breaker.before_call()
+        self.assertRaises(CircuitOpenError, breaker.before_call)
+
+    def test_success_resets_failures(self):
+        breaker = CircuitBreaker('http://middle.localhost', threshold=2)
+        breaker.failure()
+        breaker.success()
+        breaker.failure()
+        self.assertEqual(breaker.state, 'closed')
+
+
+class TestCircuitBreakers(UnitTestCase):
+
+    def response(self, status):
+        resp = Mock()
+        resp.status = status
+        return resp, b''
+
+    def test_per_host(self):
+        breakers = CircuitBreakers(threshold=1)
+        self.assertTrue(breakers.get('http://middle.localhost/resources/') is
+                        breakers.get('http://middle.localhost/other/?x=1'))
+        self.assertFalse(breakers.get('http://middle.localhost/') is breakers.get('https://middle.localhost/'))
+
+    def test_server_errors_are_failures(self):
+        breakers = CircuitBreakers(threshold=2)
+        f = Mock(return_value=self.response(503))
+
+        breakers.call('http://middle.localhost/', f)
+        breakers.call('http://middle.localhost/', f)
+        self.assertRaises(CircuitOpenError, breakers.call, 'http://middle.localhost/', f)
+        self.assertEqual(f.call_count, 2)
+
+        # other hosts are not affected
+        f.return_value = self.response(404)
+        breakers.call('http://passaporte.localhost/', f)
+        self.assertEqual(breakers.snapshot(), {
+            'http://middle.localhost': { 'state': 'open', 'failures': 2 },
+            'http://passaporte.localhost': { 'state': 'closed', 'failures': 0 },
+        })
+
+    def test_exceptions_are_failures(self):
+        breakers = CircuitBreakers(threshold=1)
+        f = Mock(side_effect=socket.error('connection refused'))
+
+        self.assertRaises(socket.error, breakers.call, 'http://middle.localhost/', f)
+        self.assertRaises(CircuitOpenError, breakers.call, 'http://middle.localhost/', f)
+        self.assertEqual(f.call_count, 1)
+
+
+class TestOpenCircuit(TestCase):
+
+    def test_fail_fast(self):
+        # nothing listens on this port
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        host = 'http://127.0.0.1:{0}'.format(sock.getsockname()[1])
+        url = host + '/resources/'
+        sock.close()
+
+        changes = []
+        def receiver(sender, **kwargs):
+            changes.append(kwargs)
+
+        remote_app = PWRemoteApp(None, 'passaporte web',
+            base_url = url,
+            request_token_url = '/sso/initiate/',
+            access_token_url = '/sso/token/',
+            authorize_url = '/sso/authorize/',
+            consumer_key = '295KkblCDT',
+            consumer_secret = 'EeAlpeFt6VteErylmwkCtLZ9qHtpomgG',
+            breakers = CircuitBreakers(threshold=2, on_change=send_circuit_state),
+        )
+        remote_app.tokengetter(lambda: ('ZHNkc2VyZWY', '17a799ddbbbfb855f25e89d0bf51ae19'))
+
+        with circuit_state.connected_to(receiver, sender=self.app):
+            self.assertRaises(socket.error, remote_app.get, url)
+            self.assertRaises(socket.error, remote_app.get, url)
+            self.assertRaises(CircuitOpenError, remote_app.get, url)
+
+        self.assertEqual(changes, [{
+            'host': host,
+            'state': 'open',
+            'previous': 'closed',
+            'failures': 2,
+        }])
+
+    @patch('flask_identity_client.startup_funcs.PWRemoteApp')
+    def test_last_known_resources(self, mock_remote_app):
+        mock_remote_app.get_instance.return_value.get.side_effect = CircuitOpenError('circuit open')
+
+        # expired long ago, without STALE_IF_ERROR
+        session = {
+            'access_token': ['ZHNkc2VyZWY', '17a799ddbbbfb855f25e89d0bf51ae19'],
+            'resources': ({ 'msg': 'some data' }, 'abc', 1000),
+        }
+        with patch('flask_identity_client.startup_funcs.session', session):
+            resources_from_middle('MIDDLE_TEST')()
+
+        self.assertEqual(session['resources'], Resources({ 'msg': 'some data' }, 'abc', 1000))
+
+    @patch('flask_identity_client.startup_funcs.PWRemoteApp')
+    def test_without_resources(self, mock_remote_app):
+        mock_remote_app.get_instance.return_value.get.side_effect = CircuitOpenError('circuit open')
+
+        session = { 'access_token': ['ZHNkc2VyZWY', '17a799ddbbbfb855f25e89d0bf51ae19'] }
+        with patch('flask_identity_client.startup_funcs.session', session):
+            resources_from_middle('MIDDLE_TEST')()
+
+        self.assertTrue(session['resources'] is None)
@@ -0,0 +1,354 @@
+# coding: UTF-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Event, Thread
+from unittest import TestCase
+from mock import patch
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+from ._redis import RedisStub
+
+from flask_identity_client.cache import LRUCache, FileSystemCache, RedisCache, memoize
+
+
+__all__ = ['TestLRUCache', 'TestMemoize', 'TestFileSystemCache', 'TestRedisCache']
+
+
+class TestLRUCache(TestCase):
+
+    def test_get_and_set(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertTrue(cache.get('b') is None)
+        self.assertEqual(cache.stats(), {
+            'hits': 1,
+            'misses': 1,
+            'evictions': 0,
+            'size': 1,
+            'maxsize': 2,
+        })
+
+    def test_least_recently_used_is_evicted(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertTrue(cache.get('b') is None)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual(len(cache), 2)
+
+    @patch('flask_identity_client.cache.time')
+    def test_expired(self, mock_time):
+        cache = LRUCache(maxsize=2, default_timeout=10)
+        mock_time.return_value = 1000
+        cache.set('a', 1)
+        cache.set('b', 2, timeout=60)
+
+        mock_time.return_value = 1010
+        self.assertTrue(cache.get('a') is None)
+        self.assertEqual(cache.get('b'), 2)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.stats()['evictions'], 0)
+
+    def test_already_expired_is_not_stored(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('a', 2, timeout=-1)
+
+        self.assertTrue(cache.get('a') is None)
+        self.assertEqual(len(cache), 0)
+
+    def test_delete_and_clear(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.delete('a')
+        cache.delete('missing')
+
+        self.assertTrue(cache.get('a') is None)
+        self.assertEqual(cache.get('b'), 2)
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_peek(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+
+        self.assertEqual(cache.peek('a'), 1)
+        self.assertTrue(cache.peek('b') is None)
+        self.assertEqual((cache.hits, cache.misses), (0, 0))
+
+
+class TestMemoize(TestCase):
+
+    def test_memoized(self):
+        calls = []
+
+        @memoize(maxsize=2)
+        def factory(*args, **kwargs):
+            calls.append((args, kwargs))
+            return object()
+
+        self.assertTrue(factory('a') is factory('a'))
+        self.assertTrue(factory('a', b=1) is factory('a', b=1))
+        self.assertFalse(factory('a') is factory('b'))
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(factory.__name__, 'factory')
+
+    def test_none_is_memoized(self):
+        calls = []
+
+        @memoize()
+        def factory(key):
+            calls.append(key)
+
+        self.assertTrue(factory('a') is None)
+        self.assertTrue(factory('a') is None)
+        self.assertEqual(calls, ['a'])
+
+    def test_bounded(self):
+        @memoize(maxsize=2)
+        def factory(key):
+            return key
+
+        for key in range(100):
+            factory(key)
+
+        stats = factory.stats()
+        self.assertEqual(stats['size'], 2)
+        self.assertEqual(stats['evictions'], 98)
+
+        factory(99)
+        self.assertEqual(factory.stats()['hits'], 1)
+
+        factory.cache_clear()
+        self.assertEqual(factory.stats()['size'], 0)
+
+    def test_stats(self):
+        @memoize()
+        def factory(key):
+            return key
+
+        for key in ('a', 'b', 'c', 'a', 'b'):
+            factory(key)
+
+        stats = factory.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 3))
+
+    @patch('flask_identity_client.cache.time')
+    def test_ttl(self, mock_time):
+        calls = []
+
+        @memoize(ttl=10)
+        def factory(key):
+            calls.append(key)
+            return key
+
+        mock_time.return_value = 1000
+        factory('a')
+        factory('a')
+        mock_time.return_value = 1010
+        factory('a')
+        self.assertEqual(calls, ['a', 'a'])
+
+    def test_concurrent_population(self):
+        calls = []
+        started = Event()
+        release = Event()
+
+        @memoize()
+        def factory(key):
+            calls.append(key)
+            started.set()
+            release.wait(1)
+            return object()
+
+        results = []
+        first = Thread(target=lambda: results.append(factory('a')))
+        first.start()
+        started.wait(1)
+        second = Thread(target=lambda: results.append(factory('a')))
+        second.start()
+        release.set()
+        first.join(1)
+        second.join(1)
+
+        self.assertEqual(calls, ['a'])
+        self.assertTrue(results[0] is results[1])
+
+
+class TestFileSystemCache(TestCase):
+
+    def setUp(self):
+        self.cache_dir = mkdtemp()
+        self.cache = FileSystemCache(self.cache_dir)
+
+    def tearDown(self):
+        rmtree(self.cache_dir)
+
+    def test_get_and_set(self):
+        self.cache.set('a', { 'uuid': 'a82670c2' })
+
+        self.assertEqual(self.cache.get('a'), { 'uuid': 'a82670c2' })
+        self.assertTrue(self.cache.get('b') is None)
+
+    def test_shared_among_instances(self):
+        self.cache.set('a', 1)
+        self.assertEqual(FileSystemCache(self.cache_dir).get('a'), 1)
+
+    @patch('flask_identity_client.cache.time')
+    def test_expired(self, mock_time):
+        mock_time.return_value = 1000
+        self.cache.set('a', 1, timeout=10)
+
+        mock_time.return_value = 1010
+        self.assertTrue(self.cache.get('a') is None)
+
+    def test_delete_and_clear(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.delete('a')
+
+        self.assertTrue(self.cache.get('a') is None)
+        self.assertEqual(self.cache.get('b'), 2)
+
+        self.cache.clear()
+        self.assertTrue(self.cache.get('b') is None)
+
+    @patch('flask_identity_client.cache.time')
+    def test_prune(self, mock_time):
+        mock_time.return_value = 1000
+        self.cache.threshold = 3
+        self.cache.prune_interval = 1
+        self.cache.set('a', 1, timeout=10)
+        self.cache.set('b', 2)
+
+        mock_time.return_value = 1010
+        self.cache.set('c', 3)
+        self.cache.set('d', 4)
+
+        # the expired one goes first
+        self.assertEqual(len(os.listdir(self.cache_dir)), 3)
+        self.assertEqual([self.cache.get(key) for key in 'bcd'], [2, 3, 4])
+
+    def test_prune_oldest(self):
+        self.cache.threshold = 5
+        self.cache.prune_interval = 1
+        self.cache.set('a', 1)
+        os.utime(self.cache._filename('a'), (1000, 1000))
+        for key in 'bcdef':
+            self.cache.set(key, 2)
+
+        # down to 80% of the threshold, then the new one
+        self.assertEqual(len(os.listdir(self.cache_dir)), 5)
+        self.assertTrue(self.cache.get('a') is None)
+        self.assertEqual(self.cache.get('f'), 2)
+
+    def test_prune_is_amortized(self):
+        self.cache.threshold = 10
+        self.cache.prune_interval = 5
+        with patch.object(self.cache, '_list_dir', wraps=self.cache._list_dir) as list_dir:
+            for key in range(100):
+                self.cache.set(unicode(key), key)
+
+        self.assertEqual(list_dir.call_count, 20)
+        self.assertTrue(len(os.listdir(self.cache_dir)) <= 10 + 5)
+
+    @patch('flask_identity_client.cache.time')
+    def test_without_threshold(self, mock_time):
+        # as a session store: only the expired entries go
+        mock_time.return_value = 1000
+        self.cache.threshold = None
+        self.cache.prune_interval = 1
+        self.cache.set('expired', 1, timeout=10)
+
+        mock_time.return_value = 1010
+        for key in range(150):
+            self.cache.set(unicode(key), key, timeout=60)
+
+        self.assertEqual(len(os.listdir(self.cache_dir)), 150)
+        self.assertTrue(self.cache.get('expired') is None)
+        self.assertEqual(self.cache.get('0'), 0)
+
+    def test_full_scans_are_amortized(self):
+        self.cache.threshold = None
+        self.cache.prune_interval = 5
+        for key in range(100):
+            self.cache.set(unicode(key), key)
+
+        with patch.object(self.cache, '_remove') as remove, \
+                patch('flask_identity_client.cache.pickle.load', wraps=pickle.load) as load:
+            for key in range(100, 200):
+                self.cache.set(unicode(key), key)
+
+        # about one read per set, not the whole directory every time
+        self.assertTrue(load.call_count <= 200, load.call_count)
+        self.assertFalse(remove.called)
+
+
+class TestRedisCache(TestCase):
+
+    def setUp(self):
+        self.server = RedisStub().start()
+        self.cache = RedisCache(port=self.server.port, key_prefix='test:')
+
+    def tearDown(self):
+        self.cache.client.close()
+        self.server.stop()
+
+    def test_get_and_set(self):
+        self.cache.set('a', { 'uuid': 'a82670c2' })
+
+        self.assertEqual(self.cache.get('a'), { 'uuid': 'a82670c2' })
+        self.assertTrue(self.cache.get('b') is None)
+        self.assertEqual(list(self.server.data), [b'test:a'])
+        self.assertEqual(self.server.commands, [b'SETEX', b'GET', b'GET'])
+
+    def test_without_timeout(self):
+        self.cache.set('a', 1, timeout=None)
+        self.cache.default_timeout = None
+        self.cache.set('b', 2)
+
+        self.assertEqual(self.server.commands, [b'SETEX', b'SET'])
+
+    def test_delete(self):
+        self.cache.set('a', 1)
+        self.cache.delete('a')
+
+        self.assertTrue(self.cache.get('a') is None)
+
+    def test_reconnect(self):
+        self.cache.set('a', 1)
+        self.cache.client._local.fd._sock.close()
+
+        self.assertEqual(self.cache.get('a'), 1)
+
+    def test_clear_prefixed(self):
+        # other users of the same database are kept
+        self.server.data[b'other:a'] = (None, b'1')
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.clear()
+
+        self.assertEqual(list(self.server.data), [b'other:a'])
+        self.assertFalse(b'FLUSHDB' in self.server.commands)
+
+    def test_clear_unprefixed(self):
+        self.cache.key_prefix = ''
+        self.cache.set('a', 1)
+        self.cache.clear()
+
+        self.assertEqual(self.server.data, {})
+        self.assertEqual(self.server.commands, [b'SETEX', b'FLUSHDB'])
@@ -0,0 +1,144 @@
+# coding: UTF-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from BaseHTTPServer import BaseHTTPRequestHandler
+from SocketServer import ThreadingTCPServer
+from threading import Thread
+from unittest import TestCase
+from mock import Mock, patch
+
+from flask_identity_client.pool import ConnectionPool
+from flask_identity_client.views import PWRemoteApp
+
+
+__all__ = ['TestConnectionPool', 'TestPooledRequests']
+
+
+class TestConnectionPool(TestCase):
+
+    def get_connection(self):
+        conn = Mock()
+        conn.sock = Mock()
+        return conn
+
+    def test_acquire_released(self):
+        pool = ConnectionPool(maxsize=2)
+        conn = self.get_connection()
+
+        self.assertTrue(pool.acquire('http:localhost') is None)
+        pool.release('http:localhost', conn)
+
+        self.assertTrue(pool.acquire('http:other') is None)
+        self.assertTrue(pool.acquire('http:localhost') is conn)
+        self.assertTrue(pool.acquire('http:localhost') is None)
+
+    def test_closed_connection_is_discarded(self):
+        pool = ConnectionPool(maxsize=2)
+        conn = self.get_connection()
+        conn.sock = None
+
+        pool.release('http:localhost', conn)
+        self.assertTrue(pool.acquire('http:localhost') is None)
+
+    def test_maxsize(self):
+        pool = ConnectionPool(maxsize=1)
+        first, second = self.get_connection(), self.get_connection()
+
+        pool.release('http:localhost', first)
+        pool.release('http:localhost', second)
+
+        second.close.assert_called_once_with()
+        self.assertTrue(pool.acquire('http:localhost') is first)
+
+    @patch('flask_identity_client.pool.time')
+    def test_idle_timeout(self, mock_time):
+        pool = ConnectionPool(maxsize=2, idle_timeout=30)
+        old, recent = self.get_connection(), self.get_connection()
+
+        mock_time.return_value = 1000
+        pool.release('http:localhost', old)
+        mock_time.return_value = 1020
+        pool.release('http:localhost', recent)
+
+        mock_time.return_value = 1035
+        self.assertTrue(pool.acquire('http:localhost') is recent)
+        old.close.assert_called_once_with()
+        self.assertTrue(pool.acquire('http:localhost') is None)
+
+    def test_clear(self):
+        pool = ConnectionPool(maxsize=2)
+        conn = self.get_connection()
+        pool.release('http:localhost', conn)
+
+        pool.clear()
+        conn.close.assert_called_once_with()
+        self.assertTrue(pool.acquire('http:localhost') is None)
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        body = b'{"msg": "some data"}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestPooledRequests(TestCase):
+
+    def setUp(self):
+        self.server = ThreadingTCPServer(('127.0.0.1', 0), KeepAliveHandler)
+        self.server.daemon_threads = True
+        self.server.connections = 0
+        thread = Thread(target=self.server.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+
+        self.url = 'http://127.0.0.1:{0}/resources/'.format(self.server.server_address[1])
+        self.remote_app = PWRemoteApp(None, 'passaporte web',
+            base_url = self.url,
+            request_token_url = '/sso/initiate/',
+            access_token_url = '/sso/token/',
+            authorize_url = '/sso/authorize/',
+            consumer_key = '295KkblCDT',
+            consumer_secret = 'EeAlpeFt6VteErylmwkCtLZ9qHtpomgG',
+        )
+        self.remote_app.tokengetter(lambda: ('ZHNkc2VyZWY', '17a799ddbbbfb855f25e89d0bf51ae19'))
+
+    def tearDown(self):
+        self.remote_app.pool.clear()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connection_is_reused(self):
+        for _ in range(3):
+            response = self.remote_app.get(self.url)
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.data, { 'msg': 'some data' })
+
+        self.assertEqual(self.server.connections, 1)
+
+    def test_concurrent_requests(self):
+        responses = []
+        threads = [
+            Thread(target=lambda: responses.append(self.remote_app.get(self.url).status))
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(responses, [200] * 4)
+        self.assertTrue(self.server.connections <= 4)
@@ -0,0 +1,236 @@
+# coding: UTF-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import zlib
+from datetime import datetime
+from unittest import TestCase
+from uuid import UUID
+from flask import Flask, Markup, session
+from flask.sessions import SecureCookieSessionInterface
+from werkzeug.exceptions import Unauthorized
+from ._redis import RedisStub
+
+from flask_identity_client.cache import LRUCache, RedisCache
+from flask_identity_client.sessions import ServerSideSessionInterface, CompactSerializer, CompactSessionInterface
+from flask_identity_client.startup_funcs import Resources
+
+
+__all__ = [
+    'TestServerSideSession', 'TestRedisServerSideSession',
+    'TestCompactServerSideSession', 'TestCompactSerializer', 'TestCompactSession',
+]
+
+
+class TestServerSideSession(TestCase):
+
+    def setUp(self):
+        self.store = self.create_store()
+        self.app = app = Flask(__name__)
+        app.session_interface = ServerSideSessionInterface(self.store)
+
+        @app.route('/set')
+        def set_value():
+            session['user_data'] = { 'uuid': 'a82670c2-027e-4079-b5c7-81f2433041b3' }
+            return 'OK'
+
+        @app.route('/get')
+        def get_value():
+            return session.get('user_data', {}).get('uuid', 'none')
+
+        @app.route('/clear')
+        def clear():
+            session.clear()
+            return 'OK'
+
+        @app.route('/login')
+        def login():
+            session.regenerate()
+            session['access_token'] = ('R0JaNT1RKNDP', 'W3oZSRHACS090Xwf')
+            return 'OK'
+
+    def create_store(self):
+        return LRUCache(maxsize=10)
+
+    def get_cookie(self, response):
+        return response.headers.get('Set-Cookie', '').partition(';')[0].partition('=')[2]
+
+    def test_cookie_holds_only_the_session_id(self):
+        with self.app.test_client() as client:
+            response = client.get('/set')
+            sid = self.get_cookie(response)
+
+            self.assertEqual(len(sid), 32)
+            self.assertTrue(self.store.get('session:' + sid) is not None)
+            self.assertEqual(client.get('/get').data, b'a82670c2-027e-4079-b5c7-81f2433041b3')
+
+    def test_unmodified_session_is_not_saved(self):
+        with self.app.test_client() as client:
+            response = client.get('/get')
+            self.assertEqual(response.data, b'none')
+            self.assertFalse('Set-Cookie' in response.headers)
+
+    def test_unknown_session_id(self):
+        with self.app.test_client() as client:
+            client.set_cookie('localhost', 'session', 'd9a795c8c8914665ac639d408209be29')
+            self.assertEqual(client.get('/get').data, b'none')
+
+            client.set_cookie('localhost', 'session', '../../etc/passwd')
+            self.assertEqual(client.get('/get').data, b'none')
+
+    def test_fixation(self):
+        with self.app.test_client() as client:
+            client.set_cookie('localhost', 'session', 'a' * 32)
+            sid = self.get_cookie(client.get('/set'))
+
+            self.assertNotEqual(sid, 'a' * 32)
+            self.assertTrue(self.store.get('session:' + 'a' * 32) is None)
+            self.assertTrue(self.store.get('session:' + sid) is not None)
+
+    def test_regenerate(self):
+        with self.app.test_client() as client:
+            before = self.get_cookie(client.get('/set'))
+            after = self.get_cookie(client.get('/login'))
+
+            self.assertNotEqual(before, after)
+            self.assertTrue(self.store.get('session:' + before) is None)
+            self.assertEqual(client.get('/get').data, b'a82670c2-027e-4079-b5c7-81f2433041b3')
+
+    def test_clear(self):
+        with self.app.test_client() as client:
+            sid = self.get_cookie(client.get('/set'))
+            client.get('/clear')
+
+            self.assertTrue(self.store.get('session:' + sid) is None)
+            self.assertEqual(client.get('/get').data, b'none')
+
+
+class TestRedisServerSideSession(TestServerSideSession):
+
+    def setUp(self):
+        self.server = RedisStub().start()
+        super(TestRedisServerSideSession, self).setUp()
+
+    def tearDown(self):
+        self.store.client.close()
+        self.server.stop()
+
+    def create_store(self):
+        return RedisCache(port=self.server.port)
+
+
+class TestCompactServerSideSession(TestServerSideSession):
+
+    def setUp(self):
+        super(TestCompactServerSideSession, self).setUp()
+        self.app.session_interface.serializer = CompactSerializer()
+
+
+class TestCompactSerializer(TestCase):
+
+    def test_round_trip(self):
+        serializer = CompactSerializer()
+        value = {
+            'resources': Resources({ 'msg': 'some data' }, '"abc"', 1234567890.5),
+            'revalidated': Resources({ 'msg': 'some data' }, None, None, 'Tue, 13 May 2014 16:00:00 GMT', True),
+            'unauthorized': Unauthorized,
+            'access_token': ('R0JaNT1RKNDP', 'W3oZSRHACS090Xwf'),
+            'uuid': UUID('a82670c2-027e-4079-b5c7-81f2433041b3'),
+            'when': datetime(2014, 1, 2, 3, 4, 5),
+            'markup': Markup('<b>John</b>'),
+            'binary': b'\xff\x00',
+            'name': 'João',
+        }
+
+        loaded = serializer.loads(serializer.dumps(value))
+        self.assertEqual(loaded, value)
+        self.assertTrue(isinstance(loaded['resources'], Resources))
+        self.assertTrue(loaded['unauthorized'] is Unauthorized)
+
+    def test_compressed_when_smaller(self):
+        serializer = CompactSerializer()
+        small = serializer.dumps({ 'a': 1 })
+        large = serializer.dumps({ 'accounts': ['d9a795c8-c891-4665-ac63-9d408209be29'] * 50 })
+
+        self.assertEqual(small[:2], b'1j')
+        self.assertEqual(large[:2], b'1d')
+        self.assertTrue(len(large) < 100)
+
+    def test_preset(self):
+        # the keys of the blueprint's sessions come almost for free
+        serializer = CompactSerializer()
+        value = { 'user_data': { 'uuid': '', 'email': '', 'full_name': '', 'accounts': [] } }
+        dumped = serializer.dumps(value)
+
+        self.assertTrue(len(dumped) < 20, len(dumped))
+        self.assertEqual(serializer.loads(dumped), value)
+
+    def test_plain_zlib(self):
+        # as written before the preset
+        data = zlib.compress(b'{"user_data":{"uuid":"a82670c2"}}')
+        self.assertEqual(CompactSerializer().loads(b'1z' + data), { 'user_data': { 'uuid': 'a82670c2' } })
+
+    def test_unknown_version(self):
+        serializer = CompactSerializer()
+        self.assertRaises(ValueError, serializer.loads, b'2j{}')
+
+
+class TestCompactSession(TestCase):
+
+    def setUp(self):
+        self.app = app = Flask(__name__)
+        app.secret_key = b'secret'
+        app.session_interface = CompactSessionInterface()
+
+        @app.route('/set')
+        def set_value():
+            session['resources'] = Resources({ 'msg': 'some data' }, '"abc"', 1234567890)
+            return 'OK'
+
+        @app.route('/get')
+        def get_value():
+            resources = session.get('resources')
+            return type(resources).__name__ + ':' + (resources.etag if resources else '')
+
+        @app.route('/login')
+        def login():
+            session['user_data'] = {
+                'uuid': 'a82670c2-027e-4079-b5c7-81f2433041b3',
+                'email': 'johndoe@myfreecomm.com.br',
+                'first_name': 'John',
+                'last_name': 'Doe',
+                'full_name': 'John Doe',
+                'accounts': ['d9a795c8-c891-4665-ac63-9d408209be29', '3f0e4c1a-7b2d-4e8f-9a61-5c2b8d7e0f14'],
+            }
+            session['access_token'] = ('R0JaNT1RKNDP', 'W3oZSRHACS090Xwf')
+            session['resources'] = Resources({ 'msg': 'some data' }, '"d41d8cd98f00b204e9800998ecf8427e"', 1400000000.25)
+            return 'OK'
+
+    def cookie_size(self):
+        response = self.app.test_client().get('/login')
+        return len(response.headers['Set-Cookie'])
+
+    def test_resources(self):
+        with self.app.test_client() as client:
+            client.get('/set')
+            self.assertEqual(client.get('/get').data, b'Resources:"abc"')
+
+    def test_invalid_cookie(self):
+        with self.app.test_client() as client:
+            client.set_cookie('localhost', 'session', 'garbage')
+            self.assertEqual(client.get('/get').data, b'NoneType:')
+
+    def test_smaller_than_default(self):
+        compact = self.cookie_size()
+        self.app.session_interface = SecureCookieSessionInterface()
+        default = self.cookie_size()
+
+        # 380 against 470 bytes
+        self.assertTrue(compact < default * 0.85, (compact, default))
+
+    def test_single_compression(self):
+        with self.app.test_client() as client:
+            client.get('/login')
+            cookie = next(iter(client.cookie_jar)).value
+        # not itsdangerous' zlib, marked with a leading dot
+        self.assertFalse(cookie.startswith('.'))
+        self.assertEqual(client.get('/get').data, b'Resources:"d41d8cd98f00b204e9800998ecf8427e"')
@@ -0,0 +1,321 @@
+# coding: UTF-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import socket
+from time import time
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Event
+from unittest import TestCase as UnitTestCase
+from mock import Mock, patch
+from flask import url_for
+from ._base import TestCase
+from ._redis import RedisStub
+
+from flask_identity_client import startup_funcs
+from flask_identity_client.cache import LRUCache, FileSystemCache, RedisCache
+from flask_identity_client.shared import SharedCache, SharedCaches, FileBus, RedisBus
+from flask_identity_client.startup_funcs import Resources, resources_from_middle, token_required
+
+
+__all__ = ['TestSharedCache', 'TestFileBus', 'TestRedisBus', 'TestRevocation', 'TestDeadStore']
+
+
+class TestSharedCache(UnitTestCase):
+
+    def setUp(self):
+        self.cache_dir = mkdtemp()
+        self.store = FileSystemCache(self.cache_dir)
+        self.bus = Mock()
+        # two processes
+        self.first = SharedCache(self.store, self.bus, name='user_data')
+        self.second = SharedCache(self.store, self.bus, name='user_data')
+
+    def tearDown(self):
+        rmtree(self.cache_dir)
+
+    def test_shared(self):
+        self.first.set('R0JaNT1RKNDP', { 'uuid': 'a82670c2' }, timeout=60)
+
+        self.assertEqual(self.second.get('R0JaNT1RKNDP'), { 'uuid': 'a82670c2' })
+        self.assertTrue(self.second.get('W3oZSRHACS090Xwf') is None)
+        self.assertTrue(self.store.get('user_data:R0JaNT1RKNDP') is not None)
+
+    def test_local_copy(self):
+        self.first.set('R0JaNT1RKNDP', True, timeout=60)
+        self.second.get('R0JaNT1RKNDP')
+
+        with patch.object(self.store, 'get') as store_get:
+            self.assertEqual(self.second.get('R0JaNT1RKNDP'), True)
+        self.assertFalse(store_get.called)
+
+    def test_delete_is_broadcast(self):
+        self.first.set('R0JaNT1RKNDP', True, timeout=60)
+        self.second.get('R0JaNT1RKNDP')
+        self.first.delete('R0JaNT1RKNDP')
+
+        self.bus.publish.assert_called_once_with('user_data', 'R0JaNT1RKNDP')
+        # the local copy is still there until the message arrives
+        self.assertEqual(self.second.get('R0JaNT1RKNDP'), True)
+        self.second.invalidated('R0JaNT1RKNDP')
+        self.assertTrue(self.second.get('R0JaNT1RKNDP') is None)
+
+    @patch('flask_identity_client.shared.time')
+    @patch('flask_identity_client.cache.time')
+    def test_local_ttl(self, mock_cache_time, mock_time):
+        mock_cache_time.return_value = mock_time.return_value = 1000
+        self.first.set('R0JaNT1RKNDP', True, timeout=60)
+        self.second.get('R0JaNT1RKNDP')
+        self.store.delete('user_data:R0JaNT1RKNDP')  # message lost
+
+        mock_cache_time.return_value = mock_time.return_value = 1005
+        self.assertTrue(self.second.get('R0JaNT1RKNDP') is None)
+
+    @patch('flask_identity_client.shared.time')
+    @patch('flask_identity_client.cache.time')
+    def test_local_copy_expires_with_the_entry(self, mock_cache_time, mock_time):
+        mock_cache_time.return_value = mock_time.return_value = 1000
+        self.first.set('R0JaNT1RKNDP', True, timeout=2)
+
+        mock_cache_time.return_value = mock_time.return_value = 1002
+        self.assertTrue(self.first.get('R0JaNT1RKNDP') is None)
+
+    def test_cache_misses(self):
+        first = SharedCache(self.store, self.bus, name='tombstones', cache_misses=True)
+        second = SharedCache(self.store, self.bus, name='tombstones', cache_misses=True)
+        self.assertTrue(second.get('secret:a') is None)
+
+        with patch.object(self.store, 'get') as store_get:
+            self.assertTrue(second.get('secret:a') is None)
+        self.assertFalse(store_get.called)
+
+        # sets are broadcast, so the miss is forgotten
+        first.set('secret:a', True, timeout=60)
+        self.bus.publish.assert_called_once_with('tombstones', 'secret:a')
+        second.invalidated('secret:a')
+        self.assertEqual(second.get('secret:a'), True)
+
+    def test_misses_not_cached_by_default(self):
+        self.assertTrue(self.second.get('R0JaNT1RKNDP') is None)
+        self.first.set('R0JaNT1RKNDP', True, timeout=60)
+
+        self.assertEqual(self.second.get('R0JaNT1RKNDP'), True)
+        self.assertFalse(self.bus.publish.called)
+
+    def test_subscribes_on_first_use(self):
+        shared = SharedCaches(self.store, self.bus)
+        self.assertFalse(self.bus.subscribe.called)
+
+        self.assertTrue(shared.cache('user_data') is shared.cache('user_data'))
+        self.bus.subscribe.assert_called_once_with(shared.invalidated)
+
+    @patch('flask_identity_client.shared.logger')
+    def test_publish_failure(self, logger):
+        self.bus.publish.side_effect = IOError
+        self.first.set('R0JaNT1RKNDP', True, timeout=60)
+        self.first.delete('R0JaNT1RKNDP')
+
+        self.assertTrue(self.first.get('R0JaNT1RKNDP') is None)
+        self.assertTrue(logger.error.called)
+
+
+class TestFileBus(UnitTestCase):
+
+    def setUp(self):
+        self.tmp = mkdtemp()
+        self.path = os.path.join(self.tmp, 'invalidations')
+        # polled by hand
+        self.first = FileBus(self.path, interval=60)
+        self.second = FileBus(self.path, interval=60)
+        self.received = []
+        self.second.subscribe(lambda name, key: self.received.append((name, key)))
+
+    def tearDown(self):
+        self.first.close()
+        self.second.close()
+        rmtree(self.tmp)
+
+    def test_publish(self):
+        self.first.publish('user_data', 'R0JaNT1RKNDP')
+        self.first.publish('resources:MIDDLE_TEST', None)
+        self.second.poll()
+
+        self.assertEqual(self.received, [('user_data', 'R0JaNT1RKNDP'), ('resources:MIDDLE_TEST', None)])
+        self.second.poll()
+        self.assertEqual(len(self.received), 2)
+
+    def test_partial_line(self):
+        with open(self.path, 'ab') as fd:
+            fd.write(b'["user_data", "R0JaN')
+        self.second.poll()
+        self.assertEqual(self.received, [])
+
+        with open(self.path, 'ab') as fd:
+            fd.write(b'T1RKNDP"]\n')
+        self.second.poll()
+        self.assertEqual(self.received, [('user_data', 'R0JaNT1RKNDP')])
+
+    def test_emptied(self):
+        self.first.max_size = 50
+        for key in ('a', 'b', 'c', 'd'):
+            self.first.publish('user_data', key)
+            self.second.poll()
+
+        self.assertEqual([key for _, key in self.received], ['a', 'b', 'c', 'd'])
+        self.assertTrue(os.path.getsize(self.path) < 50)
+
+
+class TestRedisBus(UnitTestCase):
+
+    def setUp(self):
+        self.server = RedisStub().start()
+        self.buses = []
+
+    def tearDown(self):
+        for bus in self.buses:
+            bus.close()
+            bus.client.close()
+        self.server.stop()
+
+    def make_bus(self):
+        bus = RedisBus(port=self.server.port, retry_interval=.05)
+        self.buses.append(bus)
+        return bus
+
+    def test_publish(self):
+        received = []
+        done = Event()
+
+        def callback(name, key):
+            received.append((name, key))
+            done.set()
+
+        subscriber = self.make_bus()
+        subscriber.subscribe(callback)
+        self.assertTrue(subscriber.listening.wait(1))
+
+        self.make_bus().publish('user_data', 'R0JaNT1RKNDP')
+
+        self.assertTrue(done.wait(1))
+        self.assertEqual(received, [('user_data', 'R0JaNT1RKNDP')])
+
+    def test_shared_caches(self):
+        # two processes over the same Redis
+        caches = []
+        for _ in range(2):
+            bus = self.make_bus()
+            caches.append(SharedCaches(RedisCache(port=self.server.port, client=bus.client), bus))
+        first, second = [shared.cache('validations') for shared in caches]
+        for bus in self.buses:
+            self.assertTrue(bus.listening.wait(1))
+
+        first.set('R0JaNT1RKNDP', True, timeout=60)
+        self.assertEqual(second.get('R0JaNT1RKNDP'), True)
+
+        invalidated = Event()
+        with patch.object(second, 'invalidated', side_effect=lambda key: invalidated.set()):
+            first.delete('R0JaNT1RKNDP')
+            self.assertTrue(invalidated.wait(1))
+
+
+class TestRevocation(TestCase):
+
+    def setUp(self):
+        self.bus = Mock()
+        self.config = patch.dict(self.app.config['PASSAPORTE_WEB'], {
+            'SHARED_CACHE': SharedCaches(LRUCache(), self.bus),
+            'USER_DATA_TTL': 60,
+        })
+        self.config.start()
+        self.middle = patch.dict(self.app.config['MIDDLE_TEST'], { 'CACHE_SIZE': 10 })
+        self.middle.start()
+
+    def tearDown(self):
+        self.middle.stop()
+        self.config.stop()
+        for name in ('user_data', 'validations', 'resources', 'tombstones'):
+            self.app.extensions['identity_client'].pop(name, None)
+
+    def test_tombstones_cache_misses(self):
+        with patch.dict(self.app.config['MIDDLE_TEST'], { 'PUSH_INVALIDATION': True }):
+            tombstones = startup_funcs.get_tombstones('MIDDLE_TEST')
+        self.assertTrue(tombstones.cache_misses)
+        self.assertFalse(startup_funcs.get_resources_cache('MIDDLE_TEST').cache_misses)
+
+    def test_logout(self):
+        user_data = startup_funcs.get_user_data_cache()
+        validations = startup_funcs.get_validations_cache()
+        resources = startup_funcs.get_resources_cache('MIDDLE_TEST')
+        user_data.set('R0JaNT1RKNDP', { 'uuid': 'a82670c2' }, timeout=60)
+        validations.set('R0JaNT1RKNDP', True, timeout=60)
+        resources.set('W3oZSRHACS090Xwf', Resources({ 'msg': 'some data' }, None, None), timeout=60)
+
+        session = { 'access_token': ('R0JaNT1RKNDP', 'W3oZSRHACS090Xwf'), 'user_data': {} }
+        with patch('flask_identity_client.views.session', session):
+            response = self.client.get(url_for('identity_client.logout'))
+
+        self.assertStatus(response, 302)
+        self.assertTrue(user_data.get('R0JaNT1RKNDP') is None)
+        self.assertEqual(validations.get('R0JaNT1RKNDP'), False)
+        self.assertTrue(resources.get('W3oZSRHACS090Xwf') is None)
+        self.assertEqual(sorted(call[0] for call in self.bus.publish.call_args_list), [
+            ('resources:MIDDLE_TEST', 'W3oZSRHACS090Xwf'),
+            ('user_data', 'R0JaNT1RKNDP'),
+            ('validations', 'R0JaNT1RKNDP'),
+        ])
+
+
+def dead_port():
+    # nothing listens there
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class TestDeadStore(TestCase):
+
+    def setUp(self):
+        self.store = RedisCache(host='127.0.0.1', port=dead_port())
+        self.config = patch.dict(self.app.config['PASSAPORTE_WEB'], {
+            'SHARED_CACHE': SharedCaches(self.store),
+        })
+        self.config.start()
+        self.middle = patch.dict(self.app.config['MIDDLE_TEST'], { 'CACHE_SIZE': 10 })
+        self.middle.start()
+        self.logger = patch('flask_identity_client.shared.logger')
+        self.logger.start()
+
+    def tearDown(self):
+        self.logger.stop()
+        self.middle.stop()
+        self.config.stop()
+        for name in ('validations', 'resources'):
+            self.app.extensions['identity_client'].pop(name, None)
+
+    def test_cache(self):
+        cache = SharedCache(self.store, name='user_data')
+        cache.set('R0JaNT1RKNDP', True, timeout=60)
+        cache.delete('W3oZSRHACS090Xwf')
+        cache.clear()
+
+        self.assertTrue(cache.get('R0JaNT1RKNDP') is None)
+
+    @patch('flask_identity_client.startup_funcs.PWRemoteApp')
+    def test_guarded_pages(self, mock_remote_app):
+        response = mock_remote_app.get_instance.return_value.get.return_value
+        response.status = 200
+        resources = Resources({ 'msg': 'some data' }, None, time() + 600)
+        session = {
+            'user_data': { 'uuid': 'a82670c2' },
+            'access_token': ['ZHNkc2VyZWY', '17a799ddbbbfb855f25e89d0bf51ae19'],
+            'resources': resources,
+        }
+
+        with patch('flask_identity_client.startup_funcs.session', session):
+            self.assertTrue(token_required() is None)
+            resources_from_middle('MIDDLE_TEST')()
+
+        self.assertTrue(session['resources'] is resources)
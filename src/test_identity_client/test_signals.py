@@ -0,0 +1,192 @@
+# coding: UTF-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from copy import deepcopy
+from threading import Event, current_thread
+from unittest import TestCase
+from flask import Flask, current_app
+from mock import patch
+
+from flask_identity_client import signals
+from flask_identity_client.signals import (
+    update_service_account, update_service_account_unchanged, send_update_service_account, flush,
+)
+from flask_identity_client.cache import LRUCache
+from flask_identity_client.workers import Full
+
+
+__all__ = ['TestSendUpdateServiceAccount', 'TestSkipUnchanged']
+
+
+class TestSendUpdateServiceAccount(TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config['PASSAPORTE_WEB'] = { 'ASYNC_UPDATE': True, 'UPDATE_WORKERS': 1 }
+        self.calls = []
+
+    def receiver(self, sender, user_data):
+        self.calls.append((current_thread(), current_app.name, user_data))
+
+    def test_synchronous(self):
+        self.app.config['PASSAPORTE_WEB'] = {}
+        with update_service_account.connected_to(self.receiver, sender=self.app), self.app.app_context():
+            send_update_service_account(self.app, user_data={ 'uuid': 'a' })
+
+        self.assertEqual(self.calls, [(current_thread(), self.app.name, { 'uuid': 'a' })])
+        self.assertNotIn('identity_client', self.app.extensions)
+
+    def test_asynchronous(self):
+        user_data = { 'uuid': 'a', 'accounts': [] }
+        release = Event()
+
+        def receiver(sender, user_data):
+            release.wait(1)
+            user_data['accounts'].append('changed')
+            self.receiver(sender, user_data)
+
+        with update_service_account.connected_to(receiver, sender=self.app):
+            send_update_service_account(self.app, user_data=user_data)
+            self.assertEqual(self.calls, [])
+            release.set()
+            self.assertTrue(flush(self.app, 1))
+
+        thread, app_name, received = self.calls[0]
+        self.assertFalse(thread is current_thread())
+        self.assertEqual(app_name, self.app.name)
+        self.assertEqual(received, { 'uuid': 'a', 'accounts': ['changed'] })
+        # the original is not touched
+        self.assertEqual(user_data, { 'uuid': 'a', 'accounts': [] })
+
+    def test_flush_timeout(self):
+        release = Event()
+
+        with update_service_account.connected_to(lambda sender, user_data: release.wait(1), sender=self.app):
+            send_update_service_account(self.app, user_data={})
+            self.assertFalse(flush(self.app, 0.01))
+            release.set()
+            self.assertTrue(flush(self.app, 1))
+
+    def test_flush_without_updates(self):
+        self.assertTrue(flush(self.app))
+
+    def test_full_queue(self):
+        with update_service_account.connected_to(self.receiver, sender=self.app), \
+             patch.object(signals.WorkerPool, 'submit', side_effect=Full), \
+             self.app.app_context():
+            send_update_service_account(self.app, user_data={ 'uuid': 'a' })
+
+        self.assertEqual(self.calls, [(current_thread(), self.app.name, { 'uuid': 'a' })])
+
+    def test_errors_are_logged(self):
+        def receiver(sender, user_data):
+            raise ValueError('boom')
+
+        with update_service_account.connected_to(receiver, sender=self.app), \
+             patch.object(self.app.logger, 'getChild') as mock_child:
+            send_update_service_account(self.app, user_data={})
+            flush(self.app, 1)
+
+        self.assertEqual(mock_child.return_value.exception.call_args[0][:2], ('(%s) %s', 'ValueError'))
+
+
+class TestSkipUnchanged(TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config['PASSAPORTE_WEB'] = { 'SKIP_UNCHANGED': True }
+        self.updated = []
+        self.unchanged = []
+
+    def get_user_data(self, **kwargs):
+        user_data = {
+            'uuid': 'a82670c2-027e-4079-b5c7-81f2433041b3',
+            'email': 'johndoe@myfreecomm.com.br',
+            'accounts': [
+                { 'uuid': 'd9a795c8-c891-4665-ac63-9d408209be29', 'name': 'Test Account' },
+                { 'uuid': '2f8e6a14-3e0c-4a5d-8c53-8b1dbf29b37e', 'name': 'Expired Account' },
+            ],
+        }
+        user_data.update(kwargs)
+        return user_data
+
+    def send(self, user_data):
+        def update(sender, user_data):
+            # handlers may drop accounts
+            self.updated.append(deepcopy(user_data))
+            del user_data['accounts'][1:]
+
+        def unchanged(sender, user_data):
+            self.unchanged.append(deepcopy(user_data))
+
+        with update_service_account.connected_to(update, sender=self.app), \
+             update_service_account_unchanged.connected_to(unchanged, sender=self.app):
+            send_update_service_account(self.app, user_data=user_data)
+        return user_data
+
+    def test_unchanged(self):
+        first = self.send(self.get_user_data())
+        second = self.send(self.get_user_data())
+
+        self.assertEqual(len(self.updated), 1)
+        self.assertEqual(len(self.unchanged), 1)
+        # same accounts as the handlers left them
+        self.assertEqual(second['accounts'], first['accounts'])
+        self.assertEqual(len(second['accounts']), 1)
+
+    def test_changed(self):
+        self.send(self.get_user_data())
+        self.send(self.get_user_data(email='jdoe@myfreecomm.com.br'))
+
+        self.assertEqual(len(self.updated), 2)
+        self.assertEqual(self.unchanged, [])
+
+    def test_key_order_is_irrelevant(self):
+        from collections import OrderedDict
+        self.send(self.get_user_data())
+        self.send(OrderedDict(reversed(list(self.get_user_data().items()))))
+
+        self.assertEqual(len(self.updated), 1)
+
+    def test_disabled(self):
+        self.app.config['PASSAPORTE_WEB'] = {}
+        self.send(self.get_user_data())
+        self.send(self.get_user_data())
+
+        self.assertEqual(len(self.updated), 2)
+        self.assertNotIn('identity_client', self.app.extensions)
+
+    def test_failed_update_is_not_remembered(self):
+        def update(sender, user_data):
+            raise ValueError('database is down')
+
+        with update_service_account.connected_to(update, sender=self.app):
+            self.assertRaises(ValueError, send_update_service_account, self.app, user_data=self.get_user_data())
+        self.send(self.get_user_data())
+
+        self.assertEqual(len(self.updated), 1)
+
+    def test_pluggable_store(self):
+        store = self.app.config['PASSAPORTE_WEB']['FINGERPRINT_STORE'] = LRUCache()
+        self.send(self.get_user_data())
+
+        digest, accounts = store.get('a82670c2-027e-4079-b5c7-81f2433041b3')
+        self.assertEqual(len(digest), 40)
+        self.assertEqual(len(accounts), 1)
+
+    def test_asynchronous(self):
+        self.app.config['PASSAPORTE_WEB']['ASYNC_UPDATE'] = True
+
+        def update(sender, user_data):
+            self.updated.append(user_data)
+            del user_data['accounts'][1:]
+
+        with update_service_account.connected_to(update, sender=self.app):
+            send_update_service_account(self.app, user_data=self.get_user_data())
+            flush(self.app, 1)
+            second = self.send(self.get_user_data())
+
+        self.assertEqual(len(self.updated), 1)
+        self.assertEqual(len(self.unchanged), 1)
+        # asynchronous handlers don't change the session accounts
+        self.assertEqual(len(second['accounts']), 2)
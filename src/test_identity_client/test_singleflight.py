@@ -0,0 +1,90 @@
+# coding: UTF-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from threading import Event, Thread
+from unittest import TestCase
+
+from flask_identity_client.singleflight import SingleFlight
+
+
+__all__ = ['TestSingleFlight']
+
+
+class TestSingleFlight(TestCase):
+
+    def run_concurrently(self, flight, f, count=4, timeout=None):
+        results = []
+
+        def target():
+            try:
+                results.append(flight.do('key', f, timeout=timeout))
+            except Exception as exc:
+                results.append(exc)
+
+        threads = [Thread(target=target) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads, results
+
+    def test_concurrent_calls_are_coalesced(self):
+        flight = SingleFlight()
+        release = Event()
+        calls = []
+
+        def f():
+            calls.append(1)
+            release.wait(1)
+            return 'value'
+
+        threads, results = self.run_concurrently(flight, f)
+        while 'key' not in flight:
+            pass
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, ['value'] * 4)
+        self.assertTrue(len(calls) < 4)
+        self.assertFalse('key' in flight)
+
+    def test_error_is_shared(self):
+        flight = SingleFlight()
+        release = Event()
+
+        def f():
+            release.wait(1)
+            raise ValueError('failure')
+
+        threads, results = self.run_concurrently(flight, f, count=2)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(results), 2)
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+
+    def test_bounded_wait(self):
+        flight = SingleFlight()
+        release = Event()
+        calls = []
+
+        def f():
+            calls.append(1)
+            release.wait(1)
+            return len(calls)
+
+        threads, results = self.run_concurrently(flight, f, count=1)
+        while 'key' not in flight:
+            pass
+
+        # the leader is still working, the follower gives up waiting
+        self.assertEqual(flight.do('key', lambda: 'alone', timeout=0.01), 'alone')
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [1])
+
+    def test_sequential_calls_are_not_coalesced(self):
+        flight = SingleFlight()
+        self.assertEqual(flight.do('key', lambda: 1), 1)
+        self.assertEqual(flight.do('key', lambda: 2), 2)
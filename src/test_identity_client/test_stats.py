@@ -0,0 +1,102 @@
+# coding: UTF-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from unittest import TestCase as UnitTestCase
+from flask import Flask
+from httplib2 import HttpLib2Error
+from mock import Mock, patch
+from ._base import TestCase
+
+from flask_identity_client.signals import outbound_call, OutboundCall
+from flask_identity_client.startup_funcs import resources_from_middle
+from flask_identity_client.stats import OutboundStats, enable_stats
+
+
+__all__ = ['TestOutboundStats', 'TestOutboundCall']
+
+
+class TestOutboundStats(UnitTestCase):
+
+    def test_snapshot(self):
+        stats = OutboundStats(buckets=(0.1, 1))
+        stats(None, endpoint='fetch_user_data', duration=0.05, status=200, size=100)
+        stats(None, endpoint='fetch_user_data', duration=0.5, status=200, size=50)
+        stats(None, endpoint='fetch_user_data', duration=2, error='HttpLib2Error')
+        stats(None, endpoint='MIDDLE', duration=0, cache='hit')
+
+        snapshot = stats.snapshot()
+        self.assertEqual(set(snapshot), {'fetch_user_data', 'MIDDLE'})
+
+        fetch = snapshot['fetch_user_data']
+        self.assertEqual(fetch['count'], 3)
+        self.assertEqual(fetch['errors'], 1)
+        self.assertEqual(fetch['bytes'], 150)
+        self.assertEqual(fetch['status'], {200: 2})
+        self.assertEqual(fetch['histogram'], [(0.1, 1), (1, 1), (None, 1)])
+        self.assertEqual(fetch['p50'], 1)
+        self.assertTrue(fetch['p99'] is None)
+        self.assertAlmostEqual(fetch['mean'], 2.55 / 3)
+
+        self.assertEqual(snapshot['MIDDLE']['cache'], {'hit': 1})
+        self.assertEqual(snapshot['MIDDLE']['p99'], 0.1)
+
+        stats.reset()
+        self.assertEqual(stats.snapshot(), {})
+
+    def test_enable_stats(self):
+        app = Flask(__name__)
+        stats = enable_stats(app)
+
+        with app.app_context():
+            with OutboundCall('request_token') as call:
+                call.result('200', b'oauth_token=x')
+
+        self.assertTrue(app.extensions['identity_client']['stats'] is stats)
+        self.assertEqual(stats.snapshot()['request_token']['status'], {200: 1})
+        self.assertEqual(stats.snapshot()['request_token']['bytes'], 13)
+        outbound_call.disconnect(stats, sender=app)
+
+
+class TestOutboundCall(TestCase):
+
+    def setUp(self):
+        self.events = []
+        outbound_call.connect(self.receiver, sender=self.app)
+
+    def tearDown(self):
+        outbound_call.disconnect(self.receiver, sender=self.app)
+
+    def receiver(self, sender, **kwargs):
+        self.events.append(kwargs)
+
+    def test_error(self):
+        with self.assertRaises(HttpLib2Error):
+            with OutboundCall('access_token'):
+                raise HttpLib2Error('timeout')
+
+        event, = self.events
+        self.assertEqual(event['endpoint'], 'access_token')
+        self.assertEqual(event['error'], 'HttpLib2Error')
+        self.assertTrue(event['status'] is None)
+
+    @patch('flask_identity_client.startup_funcs.PWRemoteApp')
+    def test_middle_resources(self, mock_remote_app):
+        response = Mock()
+        response.status = 304
+        response.raw_data = b''
+        response.headers = {}
+        mock_remote_app.get_instance.return_value.get.return_value = response
+
+        session = {
+            'access_token': ['ZHNkc2VyZWY', '17a799ddbbbfb855f25e89d0bf51ae19'],
+            'resources': ({ 'msg': 'some data' }, 'abc', None),
+        }
+        with patch('flask_identity_client.startup_funcs.session', session):
+            resources_from_middle('MIDDLE_TEST')()
+
+        event, = self.events
+        self.assertEqual(event['endpoint'], 'MIDDLE_TEST')
+        self.assertEqual(event['status'], 304)
+        self.assertEqual(event['cache'], 'not-modified')
+        self.assertEqual(event['size'], 0)
+        self.assertTrue(event['duration'] >= 0)
@@ -1,12 +1,18 @@
 # coding: UTF-8
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-from flask import url_for
+from threading import Thread
+from flask import Flask, url_for
 from mock import patch
 from model_resource import ServiceAccount
 from ._base import TestCase
 
-__all__ = ['TestIndex', 'TestLogin', 'TestAuthorized', 'TestLogout']
+from flask_identity_client.application import blueprint
+from flask_identity_client.cache import LRUCache
+from flask_identity_client.startup_funcs import Resources
+from flask_identity_client.views import PWRemoteApp
+
+__all__ = ['TestIndex', 'TestUserDataCache', 'TestLogin', 'TestAuthorized', 'TestLogout', 'TestPWRemoteApp']
 
 
 class TestIndex(TestCase):
@@ -156,6 +162,56 @@ class TestIndex(TestCase):
         self.assertEqual(response.headers['Location'], 'http://www.google.com/')
 
 
+class TestUserDataCache(TestCase):
+
+    def setUp(self):
+        self.store = LRUCache()
+        self.config = patch.dict(self.app.config['PASSAPORTE_WEB'], {
+            'USER_DATA_TTL': 60,
+            'USER_DATA_STORE': self.store,
+        })
+        self.config.start()
+        with self.client.session_transaction() as session:
+            session['access_token'] = ('R0JaNT1RKNDP', 'W3oZSRHACS090Xwf')
+
+    def tearDown(self):
+        self.config.stop()
+
+    @patch.object(ServiceAccount, 'update')
+    @patch('flask_identity_client.views.PWRemoteApp')
+    def test_cached(self, remote_app, update_service_account):
+        remote_app.get_instance.return_value.post.return_value.data = {
+            'uuid': 'a82670c2-027e-4079-b5c7-81f2433041b3',
+            'email': 'johndoe@myfreecomm.com.br',
+            'accounts': [{ 'uuid': 'd9a795c8-c891-4665-ac63-9d408209be29' }],
+        }
+
+        for _ in range(3):
+            response = self.client.get(url_for('identity_client.index'))
+            self.assertStatus(response, 302)
+            self.assertEqual(response.headers['Location'], url_for('index', _external=True))
+            with self.client.session_transaction() as session:
+                self.assertEqual(session['user_data'], {
+                    'uuid': 'a82670c2-027e-4079-b5c7-81f2433041b3',
+                    'email': 'johndoe@myfreecomm.com.br',
+                    'full_name': 'johndoe@myfreecomm.com.br',
+                    'accounts': ['d9a795c8-c891-4665-ac63-9d408209be29'],
+                })
+
+        self.assertEqual(remote_app.get_instance.return_value.post.call_count, 1)
+        self.assertEqual(update_service_account.call_count, 1)
+        self.assertEqual(self.store.get('R0JaNT1RKNDP')['uuid'], 'a82670c2-027e-4079-b5c7-81f2433041b3')
+
+    def test_logout_invalidates(self):
+        self.store.set('R0JaNT1RKNDP', { 'uuid': 'a82670c2-027e-4079-b5c7-81f2433041b3' })
+        self.store.set('OTHER', { 'uuid': 'a82670c2-027e-4079-b5c7-81f2433041b3' })
+
+        self.client.get(url_for('identity_client.logout'))
+
+        self.assertTrue(self.store.get('R0JaNT1RKNDP') is None)
+        self.assertFalse(self.store.get('OTHER') is None)
+
+
 class TestLogin(TestCase):
 
     endpoint = 'identity_client.login'
@@ -223,6 +279,28 @@ class TestAuthorized(TestCase):
         self.assertEqual(response.headers['Location'], url_for('identity_client.index', _external=True))
         self.assertTrue(remote_app_instance.authorized_handler.called)
         session.__setitem__.assert_called_once_with('access_token', ('R0JaNT1RKNDP', 'W3oZSRHACS090Xwf'))
+        # a new server side session id on login
+        session.regenerate.assert_called_once_with()
+
+    @patch('flask_identity_client.views.PWRemoteApp')
+    def test_new_token_drops_resources(self, remote_app):
+        remote_app.get_instance.return_value.authorized_handler.side_effect = \
+            lambda f: lambda: f({ 'oauth_token': 'R0JaNT1RKNDP', 'oauth_token_secret': 'W3oZSRHACS090Xwf' })
+        stored = {
+            'resources': Resources({ 'msg': 'some data' }, None, None),
+            'middle_resources': { 'MIDDLE_TEST': Resources({ 'msg': 'some data' }, None, None) },
+        }
+
+        session = dict(stored, access_token=['ZHNkc2VyZWY', '17a799ddbbbfb855f25e89d0bf51ae19'])
+        with patch('flask_identity_client.views.session', session):
+            self.client.get(self.get_url())
+        self.assertEqual(session, { 'access_token': ('R0JaNT1RKNDP', 'W3oZSRHACS090Xwf') })
+
+        # the same token, from a cookie: kept
+        session = dict(stored, access_token=['R0JaNT1RKNDP', 'W3oZSRHACS090Xwf'])
+        with patch('flask_identity_client.views.session', session):
+            self.client.get(self.get_url())
+        self.assertEqual(sorted(session), ['access_token', 'middle_resources', 'resources'])
 
     @patch('flask_identity_client.views.PWRemoteApp')
     @patch('flask_identity_client.views.session')
@@ -269,3 +347,51 @@ class TestLogout(TestCase):
         self.assertStatus(response, 302)
         self.assertEqual(response.headers['Location'], 'http://localhost/static/docs/')
         self.assertEqual(pop_response, {}) # todas as chaves foram removidas
+
+
+class TestPWRemoteApp(TestCase):
+
+    def make_app(self, host):
+        other = Flask(__name__)
+        other.config['PASSAPORTE_WEB'] = dict(self.app.config['PASSAPORTE_WEB'], HOST=host)
+        return other
+
+    def test_created_on_registration(self):
+        other = self.make_app('http://other.localhost')
+        other.register_blueprint(blueprint, url_prefix='/sso')
+
+        self.assertIn(other, PWRemoteApp._instances)
+        self.assertEqual(PWRemoteApp._instances[other].base_url, 'http://other.localhost')
+
+    def test_one_instance_per_app(self):
+        first = self.make_app('http://first.localhost')
+        second = self.make_app('http://second.localhost')
+
+        with first.test_request_context('/'):
+            instance = PWRemoteApp.get_instance()
+            self.assertTrue(PWRemoteApp.get_instance() is instance)
+        with second.test_request_context('/'):
+            self.assertFalse(PWRemoteApp.get_instance() is instance)
+            self.assertEqual(PWRemoteApp.get_instance().base_url, 'http://second.localhost')
+
+    def test_not_configured_yet(self):
+        other = Flask(__name__)
+        other.register_blueprint(blueprint, url_prefix='/sso')
+        self.assertNotIn(other, PWRemoteApp._instances)
+
+        other.config['PASSAPORTE_WEB'] = self.app.config['PASSAPORTE_WEB']
+        self.assertTrue(PWRemoteApp.get_instance(other) is PWRemoteApp._instances[other])
+
+    def test_concurrent_construction(self):
+        other = self.make_app('http://other.localhost')
+        instances = []
+
+        with patch.object(PWRemoteApp, 'from_config', side_effect=lambda config: object()):
+            threads = [Thread(target=lambda: instances.append(PWRemoteApp.get_instance(other))) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(1)
+
+        self.assertEqual(len(instances), 8)
+        self.assertEqual(len(set(map(id, instances))), 1)
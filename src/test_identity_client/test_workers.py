@@ -0,0 +1,58 @@
+# coding: UTF-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from threading import Event
+from unittest import TestCase
+from mock import Mock
+
+from flask_identity_client.workers import WorkerPool, Full
+
+
+__all__ = ['TestWorkerPool']
+
+
+class TestWorkerPool(TestCase):
+
+    def test_result(self):
+        pool = WorkerPool(max_workers=2)
+        futures = [pool.submit(pow, i, 2) for i in range(4)]
+
+        self.assertEqual([future.result(1) for future in futures], [0, 1, 4, 9])
+        self.assertTrue(len(pool._threads) <= 2)
+
+    def test_error(self):
+        logger = Mock()
+        pool = WorkerPool(max_workers=1, logger=logger)
+        future = pool.submit(int, 'not a number')
+
+        self.assertRaises(ValueError, future.result, 1)
+        self.assertEqual(logger.exception.call_args[0][:2], ('(%s) %s', 'ValueError'))
+
+    def test_backpressure(self):
+        pool = WorkerPool(max_workers=1, max_queue=1)
+        release = Event()
+        started = Event()
+
+        def block():
+            started.set()
+            release.wait(1)
+
+        pool.submit(block)
+        started.wait(1)
+        pool.submit(block)
+        self.assertRaises(Full, pool.submit, block)
+
+        release.set()
+        self.assertTrue(pool.join(1))
+
+    def test_join_timeout(self):
+        pool = WorkerPool(max_workers=1)
+        release = Event()
+        future = pool.submit(release.wait, 1)
+
+        self.assertFalse(pool.join(0.01))
+        self.assertFalse(future.done())
+
+        release.set()
+        self.assertTrue(pool.join(1))
+        self.assertTrue(future.done())